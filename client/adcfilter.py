@@ -0,0 +1,267 @@
+"""
+Filters of the raw ADC samples, run in batches over the samples received since the last PID cycle.
+Every filter reports its group delay and the noise of its input and output, so the latency can be traded against the
+smoothness. The noise is estimated from the differences of consecutive samples, which ignores the slow changes of
+the temperature itself.
+Filters are configured with specs like "median:5", "mean:4" or "iir:0.25", e.g. in the adcfilter key of the settings
+file.
+"""
+
+import math
+import time
+import collections
+
+class NoiseStats(object):
+    """
+    Standard deviation of the noise, estimated as the standard deviation of consecutive differences over sqrt(2).
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._last = None
+        self._n = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def extend(self, values):
+        last = self._last
+        for value in values:
+            if last is not None:
+                diff = value - last
+                self._n += 1
+                delta = diff - self._mean
+                self._mean += delta / self._n
+                self._m2 += delta * (diff - self._mean)
+            last = value
+        self._last = last
+
+    @property
+    def std(self):
+        if self._n < 2:
+            return 0.0
+        return math.sqrt(self._m2 / (self._n - 1) / 2)
+
+class Filter(object):
+    """
+    Base of the filters. decimation is the number of input samples per output sample, groupDelay is in input
+    samples.
+    """
+
+    decimation = 1
+    groupDelay = 0.0
+
+    def __init__(self):
+        self.noiseIn = NoiseStats()
+        self.noiseOut = NoiseStats()
+
+    def process(self, values):
+        """
+        Filters the batch of samples, returns the list of the output samples.
+        """
+        output = self._process(values)
+        self.noiseIn.extend(values)
+        self.noiseOut.extend(output)
+        return output
+
+    def reset(self):
+        self.resetStats()
+
+    def resetStats(self):
+        self.noiseIn.reset()
+        self.noiseOut.reset()
+
+    @property
+    def stats(self):
+        return {"delay": self.groupDelay, "noiseIn": self.noiseIn.std, "noiseOut": self.noiseOut.std}
+
+class MeanFilter(Filter):
+    """
+    Oversampling: averages every n input samples into one output sample.
+    """
+
+    def __init__(self, n):
+        Filter.__init__(self)
+        if n < 1:
+            raise ValueError("mean: n must be at least 1")
+        self.decimation = n
+        self.groupDelay = (n - 1) / 2.0
+        self.reset()
+
+    def __str__(self):
+        return "mean:%d" % self.decimation
+
+    def reset(self):
+        Filter.reset(self)
+        self._sum = 0
+        self._count = 0
+
+    def _process(self, values):
+        output = []
+        n = self.decimation
+        for value in values:
+            self._sum += value
+            self._count += 1
+            if self._count == n:
+                output.append(self._sum / float(n))
+                self._sum = 0
+                self._count = 0
+        return output
+
+class MedianFilter(Filter):
+    """
+    Spike rejection: the median of the last n samples, for every input sample.
+    """
+
+    def __init__(self, n):
+        Filter.__init__(self)
+        if n < 1 or n % 2 == 0:
+            raise ValueError("median: n must be a positive odd number")
+        self._n = n
+        self.groupDelay = (n - 1) / 2.0
+        self.reset()
+
+    def __str__(self):
+        return "median:%d" % self._n
+
+    def reset(self):
+        Filter.reset(self)
+        self._window = collections.deque(maxlen=self._n)
+
+    def _process(self, values):
+        output = []
+        window = self._window
+        for value in values:
+            window.append(value)
+            ordered = sorted(window)
+            output.append(ordered[len(ordered) // 2])
+        return output
+
+class IirFilter(Filter):
+    """
+    First order low-pass: y += alpha * (x - y). The group delay is the one at low frequencies.
+    """
+
+    def __init__(self, alpha):
+        Filter.__init__(self)
+        if not 0 < alpha <= 1:
+            raise ValueError("iir: alpha must be in (0, 1]")
+        self._alpha = alpha
+        self.groupDelay = (1 - alpha) / alpha
+        self.reset()
+
+    def __str__(self):
+        return "iir:%g" % self._alpha
+
+    def reset(self):
+        Filter.reset(self)
+        self._state = None
+
+    def _process(self, values):
+        output = []
+        alpha = self._alpha
+        state = self._state
+        for value in values:
+            state = value if state is None else state + alpha * (value - state)
+            output.append(state)
+        self._state = state
+        return output
+
+FILTERS = {"mean": (MeanFilter, int), "median": (MedianFilter, int), "iir": (IirFilter, float)}
+
+def fromSpec(spec):
+    """
+    Returns the filter of a spec like "median:5". Raises ValueError if invalid.
+    """
+    name, sep, param = spec.partition(":")
+    try:
+        filterClass, paramType = FILTERS[name.lower()]
+    except KeyError:
+        raise ValueError("Unknown filter %s" % name)
+    return filterClass(paramType(param))
+
+class FilterChain(object):
+    """
+    Filters in series. The latest output sample is kept, it is None until the first one comes out.
+    """
+
+    def __init__(self, filters=(), timeFunc=time.time):
+        self._filters = list(filters)
+        self._timeFunc = timeFunc
+        self.latest = None
+        self.resetStats()
+
+    @classmethod
+    def fromSpecs(cls, specs, timeFunc=time.time):
+        return cls([fromSpec(spec) for spec in specs], timeFunc)
+
+    def __len__(self):
+        return len(self._filters)
+
+    def __str__(self):
+        return " ".join(str(adcFilter) for adcFilter in self._filters)
+
+    @property
+    def filters(self):
+        return tuple(self._filters)
+
+    def process(self, values):
+        """
+        Runs the batch through every filter, returns the output of the last one.
+        """
+        self._inputCount += len(values)
+        for adcFilter in self._filters:
+            if not values:
+                break
+            values = adcFilter.process(values)
+        if values:
+            self.latest = values[-1]
+        return values
+
+    def reset(self):
+        for adcFilter in self._filters:
+            adcFilter.reset()
+        self.latest = None
+        self.resetStats()
+
+    def resetStats(self):
+        for adcFilter in self._filters:
+            adcFilter.resetStats()
+        self._inputCount = 0
+        self._statsBegin = self._timeFunc()
+
+    @property
+    def inputRate(self):
+        """
+        Input samples per second since the statistics were reset, or None if not known yet.
+        """
+        elapsed = self._timeFunc() - self._statsBegin
+        if elapsed <= 0 or not self._inputCount:
+            return None
+        return self._inputCount / elapsed
+
+    @property
+    def groupDelay(self):
+        """
+        Total group delay in input samples: the delay of every filter, scaled by the decimation before it.
+        """
+        delay = 0.0
+        decimation = 1
+        for adcFilter in self._filters:
+            delay += adcFilter.groupDelay * decimation
+            decimation *= adcFilter.decimation
+        return delay
+
+    def stats(self):
+        """
+        Returns the (name, stats) pairs of the filters, the delays in input samples of the chain.
+        """
+        result = []
+        decimation = 1
+        for adcFilter in self._filters:
+            stats = adcFilter.stats
+            stats["delay"] *= decimation
+            decimation *= adcFilter.decimation
+            result.append((str(adcFilter), stats))
+        return result
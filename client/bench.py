@@ -0,0 +1,198 @@
+"""
+Benchmarks of the control hot paths. Every benchmark reports the best time of one operation, in microseconds, over
+a number of repeats. The results can be saved as a baseline, and later runs fail when a benchmark got slower than
+the baseline by more than the threshold.
+Usage: bench.py [--baseline file] [--save] [--threshold ratio] [--repeat n] [benchmark ...]
+"""
+
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+import timeit
+
+import shh
+import pid
+import log
+import frame
+import trajectory
+import visualizer
+
+BASELINE_FILE = "bench_baseline.json"
+THRESHOLD = 0.25
+REPEAT = 5
+
+SHH_COEFFS = (0.049182398851342568, -0.015880288085651714, 0.0018439776862060255, -7.5225149204180178e-05)
+PROFILE = {"name": "bench", "rampup": 2.0, "ts": 90, "Tsmin": 150, "Tsmax": 200, "tl": 60, "Tl": 217, "tp": 20,
+           "Tp": 245, "rampdown": 3.0}
+
+def _frameStream(frameNo, garbageRatio=0.01, seed=0):
+    rnd = random.Random(seed)
+    chunks = []
+    for i in xrange(frameNo):
+        if rnd.random() < garbageRatio:
+            chunks.append(chr(rnd.randrange(0xFF)))
+        adcValue = rnd.randrange(1024)
+        chunks.append("\xFF" + chr(adcValue & 0xFF) + chr(adcValue >> 8))
+    return "".join(chunks)
+
+def benchFrameDecode(n):
+    """
+    Decoding one frame from a synthetic stream with 1% garbage, fed in 64 byte chunks.
+    """
+    data = _frameStream(n)
+    decoder = frame.FrameDecoder()
+    chunks = [data[i:i + 64] for i in xrange(0, len(data), 64)]
+
+    def run():
+        for chunk in chunks:
+            decoder.feed(chunk)
+    return run
+
+def benchSteinHaart(n):
+    """
+    One Steinhart-Hart conversion of resistance to Celsius.
+    """
+    converter = shh.SteinHaart(*SHH_COEFFS)
+    resistances = [500 + 2000.0 * i / n for i in xrange(n)]
+
+    def run():
+        for res in resistances:
+            converter.rToTempCelsius(res)
+    return run
+
+def benchPidCompute(n):
+    """
+    One Pid.compute() call.
+    """
+    controller = pid.Pid(coeffs=(5, 0.1, 20))
+    inputs = [25 + 200.0 * i / n for i in xrange(n)]
+
+    def run():
+        controller.setPoint = 150
+        controller.initialize()
+        for val in inputs:
+            controller._input = val
+            controller.compute()
+    return run
+
+def benchTrajectory(n):
+    """
+    Compiling a profile to segments and sampling it at the 0.5 s timebase, bypassing the trajectory cache.
+    """
+    def run():
+        for i in xrange(n):
+            trajectory.Trajectory(trajectory._buildSegments(PROFILE)).steps(0.5)
+    return run
+
+def benchLogger(n):
+    """
+    Appending one row of the ReflowControl schema to the Logger, including its share of the flushing.
+    """
+    fd, fileName = tempfile.mkstemp(prefix="bench_log_")
+    os.close(fd)
+    logger = log.Logger(("ADC", "R", "T", "p", "i", "d", "o"), fileName, background=False)
+
+    def run():
+        for i in xrange(n):
+            logger.new({"ADC": 512, "R": "1234.56", "T": "123.45"})
+            logger.extend({"p": 1.0, "i": 2.0, "d": 3.0, "o": 4.0})
+        logger.flush()
+    run.cleanup = lambda: (logger.close(), os.remove(fileName))
+    return run
+
+def benchVisualizerUpdate(n):
+    """
+    Enqueueing one live sample with Visualizer.update(). The drawing process is not started.
+    """
+    graph = visualizer.Visualizer()
+    graph.enableLive()
+
+    def run():
+        for i in xrange(n):
+            graph.update(123.45)
+    return run
+
+BENCHMARKS = (
+    ("frameDecode", benchFrameDecode, 20000),
+    ("steinHaart", benchSteinHaart, 20000),
+    ("pidCompute", benchPidCompute, 20000),
+    ("trajectory", benchTrajectory, 200),
+    ("loggerAppend", benchLogger, 20000),
+    ("visualizerUpdate", benchVisualizerUpdate, 20000),
+)
+
+def runBenchmark(factory, n, repeat=REPEAT):
+    """
+    Returns the best time of one operation in microseconds.
+    """
+    best = None
+    for i in range(repeat):
+        run = factory(n)
+        try:
+            begin = timeit.default_timer()
+            run()
+            elapsed = timeit.default_timer() - begin
+        finally:
+            if hasattr(run, "cleanup"):
+                run.cleanup()
+        best = elapsed if best is None else min(best, elapsed)
+    return best / n * 1e6
+
+def loadBaseline(fileName):
+    try:
+        with open(fileName) as file:
+            return json.load(file)
+    except IOError:
+        return {}
+
+def saveBaseline(fileName, results):
+    with open(fileName, "w") as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+        file.write("\n")
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """
+    Returns the names of the benchmarks slower than the baseline by more than the threshold ratio.
+    """
+    return [name for name, usec in sorted(results.items())
+            if name in baseline and usec > baseline[name] * (1 + threshold)]
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Benchmarks the control hot paths.")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline file, default: %s" % BASELINE_FILE)
+    parser.add_argument("--save", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="allowed slowdown ratio before failing, default: %g" % THRESHOLD)
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="repeats per benchmark, default: %d" % REPEAT)
+    parser.add_argument("benchmarks", nargs="*", help="benchmarks to run, all if omitted")
+    args = parser.parse_args(args)
+    names = [name for name, factory, n in BENCHMARKS]
+    for name in args.benchmarks:
+        if name not in names:
+            parser.error("unknown benchmark: %s, choose from %s" % (name, ", ".join(names)))
+    baseline = loadBaseline(args.baseline)
+    results = {}
+    for name, factory, n in BENCHMARKS:
+        if args.benchmarks and name not in args.benchmarks:
+            continue
+        results[name] = runBenchmark(factory, n, args.repeat)
+        if name in baseline:
+            print("%-18s %10.3f us  baseline %10.3f us  %+6.1f%%" %
+                  (name, results[name], baseline[name], (results[name] / baseline[name] - 1) * 100))
+        else:
+            print("%-18s %10.3f us" % (name, results[name]))
+    if args.save:
+        baseline.update(results)
+        saveBaseline(args.baseline, baseline)
+        return 0
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print("Regressed past %d%%: %s" % (args.threshold * 100, ", ".join(regressions)))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
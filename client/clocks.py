@@ -0,0 +1,164 @@
+"""
+Clocks for the timed components (Pid, baking, emulator, visualizer).
+RealClock follows the system's monotonic clock, which is not affected by setting the wall clock. VirtualClock runs in simulated time: its participant threads are woken one at a
+time, in the order of their deadlines, and the time jumps to the next deadline as soon as every participant sleeps.
+This makes a whole emulated bake run at full CPU speed, with the same result on every run.
+"""
+
+import sys
+import time
+import heapq
+import threading
+
+CLOCK_MONOTONIC_IDS = {"linux": 1, "darwin": 6, "freebsd": 4}
+
+def _clockGettime():
+    """
+    Returns a function reading clock_gettime(CLOCK_MONOTONIC) through ctypes, or None if the platform has none.
+    """
+    platform = sys.platform.rstrip("0123456789")
+    if platform not in CLOCK_MONOTONIC_IDS:
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+    except ImportError:
+        return None
+
+    class Timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    for libName in ("c", "rt"):  # In librt before glibc 2.17
+        path = ctypes.util.find_library(libName)
+        if path is None:
+            continue
+        try:
+            clockGettime = ctypes.CDLL(path).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clockGettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+        clockGettime.restype = ctypes.c_int
+        clockId = CLOCK_MONOTONIC_IDS[platform]
+        timespec = Timespec()
+        if clockGettime(clockId, ctypes.byref(timespec)) != 0:
+            continue
+
+        def monotonic():
+            timespec = Timespec()
+            clockGettime(clockId, ctypes.byref(timespec))
+            return timespec.tv_sec + timespec.tv_nsec * 1e-9
+        return monotonic
+    return None
+
+# Seconds from an arbitrary point, never going back. Python 2 has no time.monotonic(), and where clock_gettime() is
+# not available either, the wall clock is the last resort, and the timing goes wrong when it is set.
+monotonic = getattr(time, "monotonic", None) or _clockGettime() or time.time
+
+class RealClock(object):
+
+    def __init__(self):
+        self._timeFunc = monotonic
+
+    def now(self):
+        return self._timeFunc()
+
+    def attach(self):
+        pass
+
+    def detach(self):
+        pass
+
+    def sleepUntil(self, deadline, stopEvent=None):
+        """
+        Sleeps until the deadline or until the stop event gets set.
+        """
+        remaining = deadline - self.now()
+        if remaining <= 0:
+            return
+        if stopEvent is None:
+            time.sleep(remaining)
+        else:
+            stopEvent.wait(remaining)
+
+    def sleep(self, seconds, stopEvent=None):
+        self.sleepUntil(self.now() + seconds, stopEvent)
+
+    def waitEvent(self, event, timeout):
+        """
+        Waits at most timeout seconds for the event to get set, returns its state.
+        """
+        return event.wait(timeout)
+
+class VirtualClock(object):
+    """
+    Simulated clock. Every thread sleeping on it must attach() before it starts, and detach() when it finishes,
+    otherwise the time would either stop or advance without waiting for it. Threads blocking on anything else than
+    this clock, e.g. on a real serial port, can not participate. A thread starting several participants should
+    itself stay attached until all of them are started, so none of them can run ahead of the others.
+    """
+
+    STOP_POLL_INTERVAL = 0.05
+
+    def __init__(self, start=0.0, pollInterval=0.001):
+        self._now = start
+        self._pollInterval = pollInterval
+        self._cond = threading.Condition()
+        self._participants = 0
+        self._sleepers = []
+        self._seq = 0
+        self._woken = None
+
+    def now(self):
+        return self._now
+
+    def attach(self):
+        with self._cond:
+            self._participants += 1
+
+    def detach(self):
+        with self._cond:
+            self._participants -= 1
+            self._dispatch()
+
+    def _dispatch(self):
+        if self._woken is None and self._sleepers and len(self._sleepers) >= self._participants:
+            deadline, seq = heapq.heappop(self._sleepers)
+            self._now = max(self._now, deadline)
+            self._woken = seq
+            self._cond.notify_all()
+
+    def sleepUntil(self, deadline, stopEvent=None):
+        """
+        Sleeps until the deadline in simulated time, or until the stop event gets set. The stop event is polled in
+        real time, and a stopped sleeper leaves the time where it was.
+        """
+        with self._cond:
+            if stopEvent is not None and stopEvent.isSet():
+                return
+            seq = self._seq
+            self._seq += 1
+            entry = (deadline, seq)
+            heapq.heappush(self._sleepers, entry)
+            self._dispatch()
+            while self._woken != seq:
+                if stopEvent is None:
+                    self._cond.wait()
+                    continue
+                self._cond.wait(self.STOP_POLL_INTERVAL)
+                if stopEvent.isSet() and self._woken != seq:
+                    self._sleepers.remove(entry)
+                    heapq.heapify(self._sleepers)
+                    return
+            self._woken = None
+
+    def sleep(self, seconds, stopEvent=None):
+        self.sleepUntil(self._now + seconds, stopEvent)
+
+    def waitEvent(self, event, timeout):
+        """
+        Polls the event in pollInterval steps of simulated time, since blocking on it would stop the clock.
+        """
+        deadline = self._now + timeout
+        while not event.isSet() and self._now < deadline:
+            self.sleepUntil(min(self._now + self._pollInterval, deadline))
+        return event.isSet()
@@ -1,16 +1,134 @@
 import random
+import collections
 import serial
-import time
+
+import clocks
+import frame
+
+class OvenModel(object):
+    """
+    Lumped thermal model of the oven: the heater's power, switched by the PWM duty cycle, heats a single thermal
+    mass, which loses heat to the ambient proportionally to the temperature difference. The heater's effect is
+    delayed by the dead time.
+    Units: W, J/K, W/K, s, Celsius degrees. The state may also be a NumPy array to simulate many ovens at once.
+    """
+
+    PWM_MAX = 255
+
+    def __init__(self, heaterPower=1200.0, thermalMass=600.0, lossCoeff=4.5, deadTime=8.0, ambient=25.0,
+                 timeStep=0.01):
+        self.heaterPower = heaterPower
+        self.thermalMass = thermalMass
+        self.lossCoeff = lossCoeff
+        self.deadTime = deadTime
+        self.ambient = ambient
+        self.timeStep = timeStep
+        self.reset()
+
+    def reset(self, temp=None):
+        self.temp = self.ambient if temp is None else temp
+        delaySteps = max(1, int(round(self.deadTime / self.timeStep)))
+        self._pwmDelay = collections.deque([0] * delaySteps, delaySteps)
+
+    def step(self, pwm):
+        """
+        Advances the model by one time step with the given PWM value applied, returns the new temperature.
+        """
+        delayedPwm = self._pwmDelay[0]
+        self._pwmDelay.append(pwm)
+        heating = self.heaterPower * delayedPwm / float(self.PWM_MAX)
+        loss = self.lossCoeff * (self.temp - self.ambient)
+        self.temp = self.temp + (heating - loss) * self.timeStep / self.thermalMass
+        return self.temp
 
 class FakeSerial():
+    """
+    Emulated serial port of the oven. The PWM bytes written are fed to an OvenModel, whose temperature is converted
+    back to ADC codes sampleRate times per simulated second, and sent in legacy 0xFF lo hi frames. Like the firmware,
+    it parses the host's commands, and switches to protocol v2 frames on request.
+    timeScale is the simulated seconds per second of the clock. If it is None, the emulation runs as fast as the data
+    is read.
+    """
+
+    BUFFER_SIZE = 4096
 
-    def __init__(self):
+    def __init__(self, converter, model=None, timeScale=1.0, sampleRate=100.0, noise=0.5, seed=0, clock=None):
+        if clock is None:
+            clock = clocks.RealClock()
+        if model is None:
+            model = OvenModel(timeStep=1.0 / sampleRate)
+        self._converter = converter
+        self._model = model
+        self._timeScale = timeScale
+        self._framePeriod = 1.0 / sampleRate
+        self._modelSteps = max(1, int(round(self._framePeriod / model.timeStep)))
+        self._noise = noise
+        self._random = random.Random(seed)
+        self._pwm = 0
+        self._pwmBeforeCommand = 0
+        self._parser = frame.CommandParser()
+        self._protocol = 1
+        self._decimation = 1
+        self._samplesPerFrame = 1
+        self._adcSum = 0
+        self._adcCount = 0
+        self._samples = []
+        self._seq = 0
+        self._simTime = 0.0
+        self._clock = clock
+        self._startTime = clock.now()
         self._data = ""
         self._open = True
 
+    @property
+    def simTime(self):
+        return self._simTime
+
+    @property
+    def temp(self):
+        return self._model.temp
+
     def _genFrame(self):
-        adcValue = random.randint(350, 1023)
-        self._data = "\xFF" + chr(adcValue & 0xFF) + chr((adcValue >> 8) & 0xFF)
+        for i in range(self._modelSteps):
+            self._model.step(self._pwm)
+        self._simTime += self._framePeriod
+        temp = self._model.temp + self._random.gauss(0, self._noise)
+        adcValue = self._converter.toAdc(temp)
+        if self._protocol == 1:
+            self._data += "\xFF" + chr(adcValue & 0xFF) + chr((adcValue >> 8) & 0xFF)
+            return
+        self._adcSum += adcValue
+        self._adcCount += 1
+        if self._adcCount < self._decimation:
+            return
+        self._samples.append((self._adcSum + self._adcCount // 2) // self._adcCount)
+        self._adcSum = self._adcCount = 0
+        if len(self._samples) >= self._samplesPerFrame:
+            self._data += frame.encodeFrame(self._seq, int(self._simTime * 1000), self._samples)
+            self._seq = (self._seq + 1) & 0xFF
+            self._samples = []
+
+    def _execute(self, cmd, arg):
+        if cmd == frame.CMD_PWM:
+            self._pwm = arg
+        elif cmd == frame.CMD_DECIMATION:
+            self._decimation = max(1, arg)
+        elif cmd == frame.CMD_SAMPLES:
+            self._samplesPerFrame = min(max(1, arg), frame.V2_MAX_SAMPLES)
+        elif cmd == frame.CMD_PROTOCOL and arg in (1, 2):
+            self._protocol = arg
+            self._pwm = 0
+            self._adcSum = self._adcCount = 0
+            self._samples = []
+
+    def _catchUp(self):
+        if self._timeScale is None:
+            return
+        simNow = (self._clock.now() - self._startTime) * self._timeScale
+        while self._simTime + self._framePeriod <= simNow:
+            self._genFrame()
+        if len(self._data) > self.BUFFER_SIZE:
+            self._data = self._data[-self.BUFFER_SIZE:]  # Overrun, like a real UART buffer
 
     def _checkOpen(self):
         if not self._open:
@@ -18,20 +136,37 @@ class FakeSerial():
 
     def inWaiting(self):
         self._checkOpen()
+        self._catchUp()
         return len(self._data)
 
     def write(self, b):
-        pass
+        """
+        In the legacy protocol every byte is a PWM value, except the bytes of a valid command. In protocol v2 only
+        the commands are accepted.
+        """
+        self._checkOpen()
+        for byte in bytearray(b):
+            if self._protocol == 1:
+                if self._parser.idle:
+                    self._pwmBeforeCommand = self._pwm
+                self._pwm = byte
+            command = self._parser.push(byte)
+            if command is not None:
+                if self._protocol == 1:
+                    self._pwm = self._pwmBeforeCommand
+                self._execute(*command)
 
     def read(self, n):
         self._checkOpen()
-        if not self._data:
+        self._catchUp()
+        while len(self._data) < n:
+            if self._timeScale is not None:
+                self._clock.sleepUntil(self._startTime + (self._simTime + self._framePeriod) / self._timeScale)
+                self._checkOpen()
             self._genFrame()
         val = self._data[:n]
         self._data = self._data[n:]
-        for c in val:
-            time.sleep(0.001)
         return val
 
     def close(self):
-        self._open = False
\ No newline at end of file
+        self._open = False
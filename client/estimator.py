@@ -0,0 +1,124 @@
+"""
+Model based temperature estimator. A Kalman filter fuses the measured temperature with the applied PWM history
+through the first order plus dead time model fitted by sysid.py:
+    dT/dt = (ambient + gain * pwm(t - deadTime) - T) / tau + bias
+where the bias is a slowly drifting heating error. The model is stepped by the actual time between the updates, so
+they need not be evenly spaced. The estimate is lag compensated by running the model forward over the dead time with
+the PWM values already sent, but not yet in effect.
+"""
+
+import math
+import collections
+
+class ThermalEstimator(object):
+    """
+    Kalman filter of the (temperature, bias) state, stepped on every update.
+    measurementNoise is the standard deviation of the measured temperature in Celsius degrees. processNoise and
+    biasNoise are the standard deviations of the unmodeled changes of the temperature in Celsius degrees, and of the
+    bias in Celsius per second, over sampleTime.
+    """
+
+    def __init__(self, gain, tau, deadTime, ambient, sampleTime, measurementNoise=0.5, processNoise=0.1,
+                 biasNoise=0.01):
+        if tau <= 0 or sampleTime <= 0:
+            raise ValueError("Time constant and sample time must be positive")
+        self._gain = gain
+        self._tau = tau
+        self._deadTime = max(0.0, deadTime)
+        self._ambient = ambient
+        self._sampleTime = sampleTime
+        self._r = measurementNoise ** 2
+        self._qTemp = processNoise ** 2
+        self._qBias = biasNoise ** 2
+        self.reset()
+
+    @classmethod
+    def fromModel(cls, model, sampleTime, **kwargs):
+        """
+        Creates the estimator of a model dict of sysid.FopdtFit.model().
+        """
+        return cls(model["gain"], model["tau"], model["deadTime"], model["ambient"], sampleTime, **kwargs)
+
+    def reset(self, temp=None):
+        self._temp = temp
+        self._time = None
+        self._bias = 0.0
+        self._p = [[100.0, 0.0], [0.0, 1.0]]
+        self._pwms = collections.deque([(float("-inf"), 0)])  # (time, PWM value applied from then on)
+
+    @property
+    def horizon(self):
+        """
+        The prediction's time ahead of the measurement, in seconds. Setpoints should be looked ahead as much.
+        """
+        return self._deadTime
+
+    @property
+    def temp(self):
+        """
+        The filtered current temperature.
+        """
+        return self._temp
+
+    def _run(self, temp, begin, end):
+        """
+        Runs the model without the bias from begin to end, with the PWM values applied a dead time earlier.
+        """
+        pwms = self._pwms
+        for i in range(len(pwms)):
+            since = max(pwms[i][0], begin - self._deadTime)
+            until = min(pwms[i + 1][0], end - self._deadTime) if i + 1 < len(pwms) else end - self._deadTime
+            if until > since:
+                target = self._ambient + self._gain * pwms[i][1]
+                temp = target + (temp - target) * math.exp(-(until - since) / self._tau)
+        return temp
+
+    @property
+    def predicted(self):
+        """
+        The temperature after the dead time, when the next output starts to take effect.
+        """
+        if self._temp is None:
+            return None
+        return self._run(self._temp, self._time, self._time + self._deadTime) + self._bias * self._deadTime
+
+    @property
+    def rate(self):
+        """
+        The heating rate in Celsius per second at the predicted temperature, with the latest PWM value held.
+        """
+        temp = self.predicted
+        return (self._ambient + self._gain * self._pwms[-1][1] - temp) / self._tau + self._bias
+
+    def update(self, measured, pwm, time):
+        """
+        Takes the temperature measured at the time in seconds, and the PWM value applied since the previous update.
+        Returns the lag compensated temperature.
+        """
+        if self._temp is None:
+            self._temp = measured
+            self._time = time
+            return self.predicted
+        dt = max(0.0, time - self._time)
+        self._pwms.append((self._time, pwm))
+        a = math.exp(-dt / self._tau)
+        p = self._p
+        scale = dt / self._sampleTime
+        # Predict, F = [[a, dt], [0, 1]]
+        self._temp = self._run(self._temp, self._time, self._time + dt) + self._bias * dt
+        p00 = a * a * p[0][0] + 2 * a * dt * p[0][1] + dt * dt * p[1][1] + self._qTemp * scale
+        p01 = a * p[0][1] + dt * p[1][1]
+        p11 = p[1][1] + self._qBias * scale
+        # Correct, H = [1, 0]
+        s = p00 + self._r
+        k0 = p00 / s
+        k1 = p01 / s
+        innovation = measured - self._temp
+        self._temp += k0 * innovation
+        self._bias += k1 * innovation
+        self._p = [[(1 - k0) * p00, (1 - k0) * p01], [(1 - k0) * p01, p11 - k1 * p01]]
+        self._time = time
+        # Forget the PWM values which went out of effect
+        while len(self._pwms) > 1 and self._pwms[1][0] <= time - self._deadTime:
+            self._pwms.popleft()
+        return self.predicted
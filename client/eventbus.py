@@ -0,0 +1,148 @@
+"""
+Publish-subscribe bus between the control thread and the side effects: logging, console, plotting, telemetry.
+Publishing never blocks on a consumer: every subscriber has its own thread and a bounded queue, and when the queue
+is full the subscriber's drop policy decides which record is lost.
+"""
+
+import threading
+import collections
+
+SAMPLE = "sample"
+
+class DropPolicy:
+    OLDEST = "oldest"  # A full queue drops its oldest record to make room
+    NEWEST = "newest"  # A full queue drops the incoming record
+
+class Sample(object):
+    """
+    One PID cycle: the sensor reading, the controller's terms and its output. With an estimator, estimate is the
+    temperature fed to the controller and rate its heating rate, otherwise estimate is the measured temperature and
+    rate is None.
+    """
+
+    __slots__ = ("time", "adc", "resistance", "temp", "estimate", "rate", "fresh", "setPoint", "error", "pterm",
+                 "iterm", "dterm", "output")
+
+    def __init__(self, time=0.0, adc=0, resistance=0.0, temp=0.0, fresh=False):
+        self.time = time
+        self.adc = adc
+        self.resistance = resistance
+        self.temp = temp
+        self.estimate = temp
+        self.rate = None
+        self.fresh = fresh
+        self.setPoint = 0.0
+        self.error = 0.0
+        self.pterm = 0.0
+        self.iterm = 0.0
+        self.dterm = 0.0
+        self.output = 0.0
+
+class Subscriber(object):
+    """
+    Consumes the records of a topic on its own thread, calling callback(record) for each one.
+    """
+
+    def __init__(self, name, callback, maxSize=256, policy=DropPolicy.OLDEST):
+        self.name = name
+        self._callback = callback
+        self._maxSize = maxSize
+        self._policy = policy
+        self._queue = collections.deque()
+        self._ready = threading.Event()
+        self._stopReq = threading.Event()
+        self.delivered = 0
+        self.dropped = 0
+        self.errors = 0
+        self.lastError = None
+        self._thread = threading.Thread(target=self._consume, name="bus-" + name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def pending(self):
+        return len(self._queue)
+
+    def offer(self, record):
+        if len(self._queue) >= self._maxSize:
+            self.dropped += 1
+            if self._policy == DropPolicy.NEWEST:
+                return
+            try:
+                self._queue.popleft()
+            except IndexError:
+                pass
+        self._queue.append(record)
+        self._ready.set()
+
+    def _consume(self):
+        while True:
+            self._ready.wait()
+            self._ready.clear()
+            while True:
+                try:
+                    record = self._queue.popleft()
+                except IndexError:
+                    break
+                try:
+                    self._callback(record)
+                except Exception as e:
+                    self.errors += 1
+                    self.lastError = e
+                self.delivered += 1
+            if self._stopReq.isSet():
+                break
+
+    def stop(self):
+        """
+        Delivers the queued records, then stops the thread.
+        """
+        self._stopReq.set()
+        self._ready.set()
+        self._thread.join()
+
+    @property
+    def counters(self):
+        return {"delivered": self.delivered, "dropped": self.dropped, "pending": self.pending, "errors": self.errors}
+
+class EventBus(object):
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, topic, name, callback, maxSize=256, policy=DropPolicy.OLDEST):
+        """
+        Starts a subscriber of the topic, returns it.
+        """
+        subscriber = Subscriber(name, callback, maxSize, policy)
+        with self._lock:
+            self._subscribers[topic] = self._subscribers.get(topic, ()) + (subscriber,)
+        return subscriber
+
+    def unsubscribe(self, topic, subscriber):
+        with self._lock:
+            self._subscribers[topic] = tuple(sub for sub in self._subscribers.get(topic, ()) if sub is not subscriber)
+        subscriber.stop()
+
+    def publish(self, topic, record):
+        for subscriber in self._subscribers.get(topic, ()):
+            subscriber.offer(record)
+
+    def subscribers(self):
+        """
+        Returns the (topic, subscriber) pairs.
+        """
+        with self._lock:
+            return [(topic, sub) for topic, subs in sorted(self._subscribers.items()) for sub in subs]
+
+    def stop(self):
+        """
+        Delivers the queued records to every subscriber, and stops them.
+        """
+        with self._lock:
+            subscribers = self._subscribers
+            self._subscribers = {}
+        for subs in subscribers.values():
+            for subscriber in subs:
+                subscriber.stop()
@@ -0,0 +1,297 @@
+import struct
+
+V2_SYNC = b"\xA5\x5A"  # The first byte is the same as the command sync
+V2_VERSION = 2
+V2_HEADER = struct.Struct("<BBIB")  # Version, sequence number, MCU time in ms, sample count
+V2_MAX_SAMPLES = 32
+
+CMD_SYNC = 0xA5
+CMD_PWM = 0x01
+CMD_DECIMATION = 0x02  # ADC reads averaged into one sample
+CMD_SAMPLES = 0x03  # Samples per frame
+CMD_PROTOCOL = 0x04  # 1: legacy 3 byte frames, 2: protocol v2
+
+def _crc16Table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for i in range(8):
+            crc = (crc >> 1) ^ 0x8408 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+_CRC16_TABLE = _crc16Table()
+
+def crc16(data, crc=0xFFFF):
+    """
+    CRC-16/CCITT in the reflected form of avr-libc's _crc_ccitt_update(), starting from 0xFFFF.
+    """
+    for byte in bytearray(data):
+        crc = (crc >> 8) ^ _CRC16_TABLE[(crc ^ byte) & 0xFF]
+    return crc
+
+def crc8(data, crc=0):
+    """
+    CRC-8 with the 0x07 polynomial, like avr-libc's _crc8_ccitt_update(), starting from 0.
+    """
+    for byte in bytearray(data):
+        crc ^= byte
+        for i in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+def encodeCommand(cmd, arg):
+    """
+    Returns the host to device command: 0xA5, command, argument, CRC-8 of the command and the argument.
+    """
+    body = bytearray((cmd, arg))
+    return bytes(bytearray((CMD_SYNC,)) + body + bytearray((crc8(body),)))
+
+def encodeFrame(seq, timestamp, samples):
+    """
+    Returns the protocol v2 frame: 0xA5 0x5A sync, header, the 16 bit samples, and the CRC-16 of the header and the
+    samples, everything little endian.
+    """
+    body = V2_HEADER.pack(V2_VERSION, seq & 0xFF, timestamp & 0xFFFFFFFF, len(samples)) + \
+        struct.pack("<%dH" % len(samples), *samples)
+    return V2_SYNC + body + struct.pack("<H", crc16(body))
+
+class CommandParser(object):
+    """
+    Parses the host to device commands byte by byte, the same way the firmware does.
+    """
+
+    def __init__(self):
+        self._state = []
+
+    @property
+    def idle(self):
+        return not self._state
+
+    def push(self, byte):
+        """
+        Returns the (command, argument) tuple when the byte completes a valid command, otherwise None.
+        """
+        if not self._state and byte != CMD_SYNC:
+            return None
+        self._state.append(byte)
+        if len(self._state) < 4:
+            return None
+        sync, cmd, arg, crc = self._state
+        self._state = []
+        if crc8(bytearray((cmd, arg))) == crc:
+            return cmd, arg
+        return None
+
+class FrameDecoder(object):
+    """
+    Decoder of the firmware's ADC stream, where every sample is sent as a 0xFF sync byte followed by the 10 bit ADC
+    value in little endian order.
+    Incoming bytes are collected in a reusable buffer and every complete frame is decoded in one pass. The counters
+    tell the quality of the link.
+    """
+
+    SYNC = 0xFF
+    FRAME_LEN = 3
+    NUMPY_MIN_FRAMES = 64  # Bulk decoding, e.g. of captures, below it the plain loop is as fast and NumPy is not loaded
+
+    def __init__(self, bufferSize=4096):
+        self._buffer = bytearray(bufferSize)
+        self._view = memoryview(self._buffer)
+        self._fill = 0
+        self.resetCounters()
+
+    def resetCounters(self):
+        self.framesDecoded = 0
+        self.bytesSkipped = 0
+        self.framesMalformed = 0
+
+    @property
+    def counters(self):
+        return {"decoded": self.framesDecoded, "skipped": self.bytesSkipped, "malformed": self.framesMalformed}
+
+    def _isValid(self, pos):
+        return self._buffer[pos] == self.SYNC and self._buffer[pos + 2] & 0xF0 == 0x00
+
+    def _decodeAligned(self, pos, values):
+        """
+        Decodes the consecutive valid frames starting at pos, returns the position after the last one.
+        """
+        frameNo = (self._fill - pos) // self.FRAME_LEN
+        numpy = None
+        if frameNo >= self.NUMPY_MIN_FRAMES:
+            try:
+                import numpy
+            except ImportError:
+                pass
+        if numpy is not None:
+            frames = numpy.frombuffer(self._buffer, numpy.uint8, frameNo * self.FRAME_LEN, pos).reshape(-1, 3)
+            invalid = (frames[:, 0] != self.SYNC) | (frames[:, 2] & 0xF0 != 0)
+            if invalid.any():
+                frameNo = int(invalid.argmax())
+            frames = frames[:frameNo]
+            values.extend((frames[:, 1] | (frames[:, 2].astype(numpy.uint16) << 8)).tolist())
+        else:
+            validNo = 0
+            while validNo < frameNo and self._isValid(pos + validNo * self.FRAME_LEN):
+                sync, adcValue = struct.unpack_from("<BH", self._view, pos + validNo * self.FRAME_LEN)
+                values.append(adcValue)
+                validNo += 1
+            frameNo = validNo
+        self.framesDecoded += frameNo
+        return pos + frameNo * self.FRAME_LEN
+
+    def _decode(self, values):
+        pos = 0
+        while pos + self.FRAME_LEN <= self._fill:
+            if self._isValid(pos):
+                pos = self._decodeAligned(pos, values)
+                continue
+            if self._buffer[pos] == self.SYNC:
+                self.framesMalformed += 1
+            nextSync = self._buffer.find(b"\xFF", pos + 1, self._fill)
+            if nextSync < 0:
+                nextSync = self._fill
+            self.bytesSkipped += nextSync - pos
+            pos = nextSync
+        remaining = self._fill - pos
+        self._buffer[:remaining] = self._buffer[pos:self._fill]
+        self._fill = remaining
+
+    def feed(self, data):
+        """
+        Appends the received bytes to the buffer, and returns the list of the decoded ADC values.
+        """
+        values = []
+        dataLen = len(data)
+        offset = 0
+        while offset < dataLen:
+            chunkLen = min(dataLen - offset, len(self._buffer) - self._fill)
+            self._buffer[self._fill:self._fill + chunkLen] = data[offset:offset + chunkLen]
+            self._fill += chunkLen
+            offset += chunkLen
+            self._decode(values)
+        return values
+
+class FrameDecoderV2(object):
+    """
+    Decoder of the protocol v2 stream. A frame carries a sequence number, the MCU's time in ms, and up to
+    V2_MAX_SAMPLES ADC samples, protected by a CRC-16. Frames failing the CRC are counted as malformed and skipped,
+    gaps in the sequence numbers are counted as lost frames.
+    """
+
+    FRAME_LEN = len(V2_SYNC) + V2_HEADER.size + 2 + 2  # The shortest frame, with one sample
+
+    def __init__(self, bufferSize=4096):
+        self._buffer = bytearray(bufferSize)
+        self._view = memoryview(self._buffer)
+        self._fill = 0
+        self.lastSeq = None
+        self.lastTimestamp = None
+        self.resetCounters()
+
+    def resetCounters(self):
+        self.framesDecoded = 0
+        self.bytesSkipped = 0
+        self.framesMalformed = 0
+        self.framesLost = 0
+
+    @property
+    def counters(self):
+        return {"decoded": self.framesDecoded, "skipped": self.bytesSkipped, "malformed": self.framesMalformed,
+                "lost": self.framesLost}
+
+    def _skip(self, pos):
+        nextSync = self._buffer.find(V2_SYNC, pos + 1, self._fill)
+        if nextSync < 0:
+            nextSync = self._fill - 1 if self._buffer[self._fill - 1] == CMD_SYNC else self._fill  # Half a sync
+        self.bytesSkipped += nextSync - pos
+        return nextSync
+
+    def _decode(self, frames):
+        pos = 0
+        headerEnd = len(V2_SYNC) + V2_HEADER.size
+        while pos + headerEnd <= self._fill:
+            if self._buffer[pos:pos + len(V2_SYNC)] != V2_SYNC:
+                pos = self._skip(pos)
+                continue
+            version, seq, timestamp, count = V2_HEADER.unpack_from(self._view, pos + len(V2_SYNC))
+            if version != V2_VERSION or not 0 < count <= V2_MAX_SAMPLES:
+                self.framesMalformed += 1
+                pos = self._skip(pos)
+                continue
+            frameEnd = pos + headerEnd + 2 * count + 2
+            if frameEnd > self._fill:
+                break
+            crc, = struct.unpack_from("<H", self._view, frameEnd - 2)
+            if crc16(self._view[pos + len(V2_SYNC):frameEnd - 2]) != crc:
+                self.framesMalformed += 1
+                pos = self._skip(pos)
+                continue
+            if self.lastSeq is not None:
+                self.framesLost += (seq - self.lastSeq - 1) & 0xFF
+            self.lastSeq = seq
+            self.lastTimestamp = timestamp
+            self.framesDecoded += 1
+            frames.append((seq, timestamp, struct.unpack_from("<%dH" % count, self._view, pos + headerEnd)))
+            pos = frameEnd
+        remaining = self._fill - pos
+        self._buffer[:remaining] = self._buffer[pos:self._fill]
+        self._fill = remaining
+
+    def feedFrames(self, data):
+        """
+        Appends the received bytes to the buffer, and returns the list of the decoded (sequence number, MCU time,
+        samples) tuples.
+        """
+        frames = []
+        dataLen = len(data)
+        offset = 0
+        while offset < dataLen:
+            chunkLen = min(dataLen - offset, len(self._buffer) - self._fill)
+            self._buffer[self._fill:self._fill + chunkLen] = data[offset:offset + chunkLen]
+            self._fill += chunkLen
+            offset += chunkLen
+            self._decode(frames)
+        return frames
+
+    def feed(self, data):
+        """
+        Appends the received bytes to the buffer, and returns the list of the decoded ADC values.
+        """
+        return [value for seq, timestamp, samples in self.feedFrames(data) for value in samples]
+
+class LinkDecoder(object):
+    """
+    Decodes the legacy stream, until the first valid protocol v2 frame arrives, then the v2 stream only.
+    """
+
+    FRAME_LEN = FrameDecoder.FRAME_LEN  # The shortest frame of the two
+
+    def __init__(self, bufferSize=4096):
+        self._legacy = FrameDecoder(bufferSize)
+        self._v2 = FrameDecoderV2(bufferSize)
+        self.protocol = 1
+
+    def resetCounters(self):
+        self._legacy.resetCounters()
+        self._v2.resetCounters()
+
+    @property
+    def counters(self):
+        counters = (self._v2 if self.protocol == 2 else self._legacy).counters
+        counters["protocol"] = self.protocol
+        return counters
+
+    def feed(self, data):
+        """
+        Appends the received bytes to the buffer, and returns the list of the decoded ADC values.
+        """
+        if self.protocol == 2:
+            return self._v2.feed(data)
+        values = self._v2.feed(data)
+        if values:
+            self.protocol = 2
+            self._v2.bytesSkipped = 0  # Forget the legacy bytes skipped while probing, the v2 counts are kept
+            return values
+        return self._legacy.feed(data)
@@ -0,0 +1,108 @@
+"""
+Latency instrumentation of the serial to PWM pipeline: timestamps at the stages, and fixed bucket histograms of the
+durations between them. Recording is off by default; when off, every stage costs a single attribute check.
+"""
+
+import bisect
+import collections
+
+import clocks
+
+now = clocks.monotonic
+
+def _buckets():
+    bounds = []
+    decade = 1e-6
+    while decade < 10:
+        bounds.extend((decade, 2 * decade, 5 * decade))
+        decade *= 10
+    return tuple(bounds)
+
+BUCKETS = _buckets()  # Upper bounds in seconds: 1 us, 2 us, 5 us, ... 5 s, and an overflow bucket above
+
+class Histogram(object):
+    """
+    Counts values into fixed buckets. The percentiles are the upper bounds of the buckets they fall into, or the
+    maximum for the overflow bucket.
+    """
+
+    def __init__(self, bounds=BUCKETS):
+        self._bounds = bounds
+        self.reset()
+
+    def reset(self):
+        self._counts = [0] * (len(self._bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, pct):
+        if not self.count:
+            return 0.0
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for idx, bucketCount in enumerate(self._counts):
+            seen += bucketCount
+            if seen >= rank and bucketCount:
+                return min(self._bounds[idx], self.max) if idx < len(self._bounds) else self.max
+        return self.max
+
+class LatencyStats(object):
+    """
+    Histograms of the pipeline stages:
+    age: time from the sample's arrival on the serial port until the PID reads it.
+    compute: Pid.compute().
+    callback: the CALC callbacks after the computation.
+    endToEnd: time from the sample's arrival until the new PWM value is written to the serial port.
+    """
+
+    STAGES = ("age", "compute", "callback", "endToEnd")
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, stages=STAGES, bounds=BUCKETS):
+        self.enabled = False
+        self._marks = {}
+        self._histograms = collections.OrderedDict((stage, Histogram(bounds)) for stage in stages)
+
+    def mark(self, name):
+        self._marks[name] = now()
+
+    def copyMark(self, name, newName):
+        """
+        Sets the mark newName to the time of the mark name, so it is kept while name is marked again.
+        """
+        self._marks[newName] = self._marks.get(name)
+
+    def add(self, stage, duration):
+        self._histograms[stage].add(duration)
+
+    def addSince(self, stage, markName, clear=False):
+        """
+        Records the time elapsed since the named mark, if it was set. If clear is set, the mark is removed.
+        """
+        begin = self._marks.pop(markName, None) if clear else self._marks.get(markName)
+        if begin is not None:
+            self._histograms[stage].add(now() - begin)
+
+    def reset(self):
+        for histogram in self._histograms.values():
+            histogram.reset()
+        self._marks.clear()
+
+    def summary(self, percentiles=PERCENTILES):
+        """
+        Returns (stage, count, mean, [percentiles], max) tuples, the durations in seconds.
+        """
+        return [(stage, histogram.count, histogram.mean, [histogram.percentile(pct) for pct in percentiles],
+                 histogram.max) for stage, histogram in self._histograms.items()]
@@ -1,37 +1,70 @@
 import time
+import threading
 
 class Logger(object):
+    """
+    CSV-like logger with a schema declared up front.
+    Entries are collected in memory and written to the file in batches by a background thread, when flushSize rows
+    are pending or flushInterval seconds elapsed. Keys not in the schema are ignored.
+    Without the background thread the owner has to call flush() periodically.
+    """
 
-    def __init__(self):
-        self._fileName = "log_%s" % time.strftime("%H-%M-%S")
-        with open(self._fileName, "w"):
-            pass
-        self._header = []
+    def __init__(self, fields, fileName=None, flushSize=256, flushInterval=1.0, background=True):
+        if fileName is None:
+            fileName = "log_%s" % time.strftime("%H-%M-%S")
+        self._fileName = fileName
+        self._fields = tuple(fields)
+        self._flushSize = flushSize
+        self._flushInterval = flushInterval
+        with open(self._fileName, "w") as file:
+            file.write(";".join(str(key) for key in self._fields) + "\n")
         self._entry = {}
+        self._rows = []
+        self._rowsLock = threading.Lock()
+        self._fileLock = threading.Lock()
+        self._flushReq = threading.Event()
+        self._stopReq = threading.Event()
         self._enabled = True
+        self._writerThread = None
+        if background:
+            self._writerThread = threading.Thread(target=self._write)
+            self._writerThread.daemon = True
+            self._writerThread.start()
+
+    @property
+    def fields(self):
+        return self._fields
 
     def _appendEntry(self):
         if not self._enabled:
             return
-        headerChanged = False
-        for key in self._entry.keys():
-            if key not in self._header:
-                self._header.append(key)
-                headerChanged = True
-        if headerChanged:
-            with open(self._fileName, "r+") as file:
-                file.readline()
-                log = file.read()
-                file.seek(0)
-                file.write(";".join(str(key) for key in self._header) + "\n")
-                file.write(log)
-                file.truncate()
-        with open(self._fileName, "a") as file:
-            for key in self._header:
-                if key in self._entry:
-                    file.write(str(self._entry[key]))
-                file.write(";")
-            file.write("\n")
+        row = tuple(self._entry.get(key, "") for key in self._fields)
+        with self._rowsLock:
+            self._rows.append(row)
+            pending = len(self._rows)
+        if pending >= self._flushSize:
+            self._flushReq.set()
+
+    @property
+    def pending(self):
+        return len(self._rows)
+
+    def _writeRows(self):
+        # The file lock is held from taking the rows until they are written, so concurrent flushes keep the order
+        with self._fileLock:
+            with self._rowsLock:
+                rows = self._rows
+                self._rows = []
+            if not rows:
+                return
+            with open(self._fileName, "a") as file:
+                file.writelines("".join(str(val) + ";" for val in row) + "\n" for row in rows)
+
+    def _write(self):
+        while not self._stopReq.isSet():
+            self._flushReq.wait(self._flushInterval)
+            self._flushReq.clear()
+            self._writeRows()
 
     def new(self, entry):
         if self._entry:
@@ -41,3 +74,22 @@ class Logger(object):
 
     def extend(self, entry):
         self._entry.update(entry)
+
+    def flush(self):
+        """
+        Writes out the pending rows synchronously.
+        """
+        self._writeRows()
+
+    def close(self):
+        """
+        Stops the writer thread, and writes out every pending row, including the one under construction.
+        """
+        if self._entry:
+            self._appendEntry()
+            self._entry = {}
+        self._stopReq.set()
+        self._flushReq.set()
+        if self._writerThread is not None:
+            self._writerThread.join()
+        self._writeRows()
@@ -0,0 +1,260 @@
+"""
+Controls many ovens from one thread. The serial I/O, the PID ticks, the setpoint playback and the log flushing of
+every oven are callbacks on a single select() based event loop, so the number of threads does not grow with the
+number of ovens.
+Usage: multioven.py [--bake] settingsfile [settingsfile ...]
+Every settings file has the format of .reflowcntrlrc, and describes one oven.
+"""
+
+import os
+import sys
+import time
+import heapq
+import select
+import argparse
+import serial
+
+import clocks
+import shh
+import pid
+import storage
+import emulator
+import log
+import profiles
+import frame
+import samplebuffer
+
+class _Timer(object):
+
+    def __init__(self, callback, args, period):
+        self.callback = callback
+        self.args = args
+        self.period = period
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class EventLoop(object):
+    """
+    Single threaded event loop with timers on a heap, and file descriptors polled for reading with select().
+    """
+
+    def __init__(self, clock=None):
+        if clock is None:
+            clock = clocks.RealClock()
+        self._clock = clock
+        self._timers = []
+        self._seq = 0
+        self._readers = {}
+        self._stopReq = False
+
+    @property
+    def clock(self):
+        return self._clock
+
+    def now(self):
+        return self._clock.now()
+
+    def _schedule(self, when, timer):
+        heapq.heappush(self._timers, (when, self._seq, timer))
+        self._seq += 1
+        return timer
+
+    def callAt(self, when, callback, *args):
+        return self._schedule(when, _Timer(callback, args, None))
+
+    def callLater(self, delay, callback, *args):
+        return self.callAt(self.now() + delay, callback, *args)
+
+    def callEvery(self, period, callback, *args):
+        """
+        Calls the callback periodically on absolute deadlines, starting now. Returns the timer, which can be
+        cancelled.
+        """
+        return self._schedule(self.now(), _Timer(callback, args, period))
+
+    def addReader(self, fd, callback, *args):
+        self._readers[fd] = (callback, args)
+
+    def removeReader(self, fd):
+        self._readers.pop(fd, None)
+
+    def _runTimers(self):
+        now = self.now()
+        while self._timers and self._timers[0][0] <= now:
+            when, seq, timer = heapq.heappop(self._timers)
+            if timer.cancelled:
+                continue
+            if timer.period is not None:
+                nextTime = when + timer.period
+                if nextTime <= now:
+                    nextTime += (int((now - nextTime) // timer.period) + 1) * timer.period  # Skip missed ones
+                self._schedule(nextTime, timer)
+            timer.callback(*timer.args)
+
+    def _poll(self):
+        timeout = None
+        if self._timers:
+            timeout = max(0, self._timers[0][0] - self.now())
+        if self._readers:
+            readable = select.select(list(self._readers), [], [], timeout)[0]
+            for fd in readable:
+                callback, args = self._readers[fd]
+                callback(*args)
+        elif timeout is not None:
+            self._clock.sleep(timeout)
+
+    def run(self):
+        self._stopReq = False
+        while not self._stopReq and (self._timers or self._readers):
+            self._runTimers()
+            if not self._stopReq:
+                self._poll()
+
+    def stop(self):
+        self._stopReq = True
+
+class Oven(object):
+    """
+    One oven on the shared event loop, with its own Pid, profiles and settings.
+    """
+
+    TIMEBASE = 0.5
+    POLL_INTERVAL = 0.01
+    FLUSH_INTERVAL = 1.0
+    LOG_FIELDS = ("ADC", "T", "spt", "o")
+
+    def __init__(self, loop, name, settings):
+        self._loop = loop
+        self._name = name
+        self._converter = shh.AdcConverter(settings.getShhCoeffs(), settings.getUref(), settings.getIref(),
+                                           settings.getAdcComp())
+        self._profiles = profiles.ProfileRegistry(settings.getProfiles())
+        self._currentProfile = self._profiles.default
+        self._pid = pid.Pid(self._updateTemp, self._setPwm, settings.getPidCoeffs(), loop.clock)
+        self._pid.sampleTime = 0.5
+        self._samples = samplebuffer.SampleBuffer(timeFunc=loop.now)
+        self._decoder = frame.LinkDecoder()
+        self._pwm = 0
+        portName = settings.getSerial()
+        if portName is not None:
+            self._serial = serial.Serial(port=portName, baudrate=57600, timeout=0)
+        else:
+            self._serial = emulator.FakeSerial(self._converter, clock=loop.clock)
+        self._logger = log.Logger(self.LOG_FIELDS, "log_%s_%s" % (name, time.strftime("%H-%M-%S")),
+                                  background=False)
+        self._timers = []
+        self._bakeTimer = None
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def isBaking(self):
+        return self._bakeTimer is not None
+
+    def _updateTemp(self):
+        adcValue = self._samples.last(350)
+        temp = self._converter.toCelsius(adcValue)
+        self._logger.new({"ADC": adcValue, "T": "%.2f" % temp, "spt": self._pid.setPoint})
+        return temp
+
+    def _write(self, data):
+        try:
+            self._serial.write(data)
+        except serial.SerialException:
+            pass
+
+    def _setPwm(self, toValue):
+        self._pwm = int(round(toValue))
+        if self._decoder.protocol == 2:
+            self._write(frame.encodeCommand(frame.CMD_PWM, self._pwm))
+        else:
+            self._write(chr(self._pwm))
+        self._logger.extend({"o": toValue})
+
+    def _read(self):
+        try:
+            data = self._serial.read(self._serial.inWaiting())
+        except serial.SerialException:
+            return
+        protocol = self._decoder.protocol
+        adcValues = self._decoder.feed(data)
+        if self._decoder.protocol != protocol:
+            self._setPwm(self._pwm)  # Like in ReflowControl, the firmware ignores legacy PWM bytes once in v2
+        if adcValues:
+            self._samples.extend(adcValues)
+
+    def start(self):
+        self._write(frame.encodeCommand(frame.CMD_PROTOCOL, 2))  # Older firmware keeps sending legacy frames
+        self._setPwm(0)
+        self._pid.initialize()
+        if hasattr(self._serial, "fileno"):
+            self._loop.addReader(self._serial.fileno(), self._read)
+        else:
+            self._timers.append(self._loop.callEvery(self.POLL_INTERVAL, self._read))
+        self._timers.append(self._loop.callEvery(self._pid.sampleTime, self._pid.tick))
+        self._timers.append(self._loop.callEvery(self.FLUSH_INTERVAL, self._logger.flush))
+
+    def bake(self, profileName=None):
+        """
+        Starts baking the named profile, the current one if None. An unknown profile is reported, and the oven stays
+        idle, so the other ovens on the loop are not affected.
+        """
+        if self._bakeTimer is not None:
+            return
+        profile = self._currentProfile if profileName is None else self._profiles.get(profileName)
+        if profile is None:
+            print("%s: profile %s not found, not baking." % (self._name, profileName or "default"))
+            return
+        self._currentProfile = profile
+        setPoints = iter(self._profiles.trajectory(self._currentProfile["name"]).steps(self.TIMEBASE)[1])
+        self._bakeTimer = self._loop.callEvery(self.TIMEBASE, self._nextSetPoint, setPoints)
+
+    def _nextSetPoint(self, setPoints):
+        try:
+            self._pid.setPoint = next(setPoints) + 7  # Same offset as in ReflowControl._applySetPoint()
+        except StopIteration:
+            self.stopBake()
+
+    def stopBake(self):
+        if self._bakeTimer is not None:
+            self._bakeTimer.cancel()
+            self._bakeTimer = None
+        self._pid.setPoint = 0
+
+    def stop(self):
+        self.stopBake()
+        self._setPwm(0)
+        for timer in self._timers:
+            timer.cancel()
+        if hasattr(self._serial, "fileno"):
+            self._loop.removeReader(self._serial.fileno())
+        self._serial.close()
+        self._logger.close()
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Controls many reflow ovens from one process.")
+    parser.add_argument("--bake", action="store_true", help="start baking the default profile in every oven")
+    parser.add_argument("settings", nargs="+", help="settings file of an oven")
+    args = parser.parse_args(args)
+    loop = EventLoop()
+    ovens = []
+    for fileName in args.settings:
+        oven = Oven(loop, os.path.basename(fileName).lstrip("."), storage.Storage(fileName))
+        oven.start()
+        if args.bake:
+            oven.bake()
+        ovens.append(oven)
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for oven in ovens:
+            oven.stop()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -2,9 +2,56 @@
 Based on http://brettbeauregard.com/blog/2011/04/improving-the-beginners-pid-introduction/
 """
 
-import time
+import math
 import threading
 
+import clocks
+import latency
+
+class LoopStats(object):
+    """
+    Timing statistics of the PID loop: lateness of every cycle relative to its deadline, jitter of the cycle period,
+    and the number of overruns, i.e. deadlines skipped because a cycle took longer than the sample time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._cycles = 0
+            self._latenessSum = 0.0
+            self._latenessMax = 0.0
+            self._periodCount = 0
+            self._periodMean = 0.0
+            self._periodM2 = 0.0
+            self._lastBegin = None
+            self._overruns = 0
+
+    def add(self, begin, deadline, skipped):
+        with self._lock:
+            lateness = begin - deadline
+            self._cycles += 1
+            self._latenessSum += lateness
+            self._latenessMax = max(self._latenessMax, lateness)
+            self._overruns += skipped
+            if self._lastBegin is not None:
+                period = begin - self._lastBegin
+                self._periodCount += 1
+                delta = period - self._periodMean
+                self._periodMean += delta / self._periodCount
+                self._periodM2 += delta * (period - self._periodMean)
+            self._lastBegin = begin
+
+    @property
+    def summary(self):
+        with self._lock:
+            cycles = max(self._cycles, 1)
+            jitter = math.sqrt(self._periodM2 / self._periodCount) if self._periodCount > 1 else 0.0
+            return {"cycles": self._cycles, "lateMean": self._latenessSum / cycles, "lateMax": self._latenessMax,
+                    "period": self._periodMean, "jitter": jitter, "overruns": self._overruns}
+
 class Pid(object):
 
     class Modes:
@@ -21,7 +68,10 @@ class Pid(object):
         CALC = 2
         OUT = 3
 
-    def __init__(self, updateCallback=None, outputChangedCallback=None, coeffs=None):
+    def __init__(self, updateCallback=None, outputChangedCallback=None, coeffs=None, clock=None):
+        if clock is None:
+            clock = clocks.RealClock()
+        self._clock = clock
         if coeffs is None:
             coeffs = (1, 0, 0)
         self._kp, self._ki, self._kd = coeffs
@@ -39,14 +89,20 @@ class Pid(object):
         self._iterm = 0
         self._dterm = 0
         self._lastInput = 0
+        self._inputRate = None
+        self._lastOutput = ~self._output
         self._outMin = 0
         self._outMax = 255
 
         self._updateCallback = updateCallback
-        self._calcDoneCallback = None
-        self._outputChangedCallback = outputChangedCallback
+        self._calcDoneCallbacks = ()
+        self._outputChangedCallbacks = (outputChangedCallback,) if outputChangedCallback is not None else ()
         self._stopReq = threading.Event()
         self._updateThread = None
+        self._triggerOnSample = False
+        self._sampleReady = threading.Event()
+        self._loopStats = LoopStats()
+        self._latencyStats = latency.LatencyStats()
 
     @property
     def kp(self):
@@ -140,6 +196,18 @@ class Pid(object):
         if not self._cntrlMode & Pid.Modes.AUTO_READ:
             self._input = val
 
+    @property
+    def inputRate(self):
+        """
+        The rate of change of the input per second, e.g. of a model based estimator. If set, the derivative term
+        uses it instead of the difference of consecutive inputs.
+        """
+        return self._inputRate
+
+    @inputRate.setter
+    def inputRate(self, val):
+        self._inputRate = val
+
     @property
     def output(self):
         return self._output
@@ -157,17 +225,58 @@ class Pid(object):
     def setPoint(self, val):
         self._setpoint = val
 
+    @property
+    def triggerOnSample(self):
+        """
+        If set, every cycle waits after its deadline for a fresh sample signaled by notifySample(), at most for a
+        sample time, and computes right when it arrives.
+        """
+        return self._triggerOnSample
+
+    @triggerOnSample.setter
+    def triggerOnSample(self, val):
+        self._triggerOnSample = val
+
+    @property
+    def loopStats(self):
+        return self._loopStats
+
+    @property
+    def latencyStats(self):
+        """
+        Latency histograms, recording the compute and callback times of every cycle while enabled.
+        """
+        return self._latencyStats
+
+    def notifySample(self):
+        self._sampleReady.set()
+
     @property
     def isRunning(self):
         return not self._stopReq.isSet()
 
     def attachCallback(self, type, callback):
+        """
+        Sets the update callback, which provides the input. Any number of CALC and OUT callbacks can be attached,
+        they are called in the order of attaching.
+        """
         if type == self.CallbackType.UPDATE:
             self._updateCallback = callback
         elif type == self.CallbackType.CALC:
-            self._calcDoneCallback = callback
+            self._calcDoneCallbacks += (callback,)
+        elif type == self.CallbackType.OUT:
+            self._outputChangedCallbacks += (callback,)
+        else:
+            raise Exception("Unknown callback type")
+
+    def detachCallback(self, type, callback):
+        if type == self.CallbackType.UPDATE:
+            if self._updateCallback == callback:
+                self._updateCallback = None
+        elif type == self.CallbackType.CALC:
+            self._calcDoneCallbacks = tuple(cb for cb in self._calcDoneCallbacks if cb != callback)
         elif type == self.CallbackType.OUT:
-            self._outputChangedCallback = callback
+            self._outputChangedCallbacks = tuple(cb for cb in self._outputChangedCallbacks if cb != callback)
         else:
             raise Exception("Unknown callback type")
 
@@ -184,7 +293,10 @@ class Pid(object):
 
     def compute(self):
         self._error = self._setpoint - self._input
-        dInput = self._input - self._lastInput
+        if self._inputRate is None:
+            dInput = self._input - self._lastInput
+        else:
+            dInput = self._inputRate * self._sampleTime
         self._pterm = self._kp * self._error
         self._iterm = self._clamp(self._iterm + self._ki * self._error, self._outMin, self._outMax)
         self._dterm = self._kd * dInput
@@ -192,33 +304,164 @@ class Pid(object):
         self._output = self._clamp(pidResult, self._outMin, self._outMax)
         self._lastInput = self._input
 
+    def _timedCompute(self):
+        begin = latency.now()
+        self.compute()
+        computed = latency.now()
+        self._latencyStats.add("compute", computed - begin)
+        if self._calcDoneCallbacks:
+            self._callCalcDone()
+            self._latencyStats.add("callback", latency.now() - computed)
+
+    def _callCalcDone(self):
+        for callback in self._calcDoneCallbacks:
+            callback(self._error, self._pterm, self._iterm, self._dterm, self._output)
+
     def _update(self):
+        try:
+            self._updateLoop()
+        finally:
+            self._clock.detach()
+
+    def tick(self):
+        """
+        Runs one cycle of the controller: reads the input, computes, and signals the output, according to the mode.
+        The update thread calls it on every sample time, or it can be driven from outside without start().
+        """
+        if self._cntrlMode & Pid.Modes.AUTO_READ and self._updateCallback is not None:
+            self._input = self._updateCallback()
+        if self.cntrlMode & Pid.Modes.AUTO_CALC:
+            if self._latencyStats.enabled:
+                self._timedCompute()
+            else:
+                self.compute()
+                self._callCalcDone()
+        if self._cntrlMode & Pid.Modes.AUTO_OUT and self._output != self._lastOutput:
+            for callback in self._outputChangedCallbacks:
+                callback(self._output)
+        self._lastOutput = self._output
+
+    def _updateLoop(self):
         self._stopReq.clear()
-        lastOutput = ~self._output
+        self._lastOutput = ~self._output
+        deadline = self._clock.now()
+        skipped = 0
         while not self._stopReq.isSet():
-            begin = time.time()
-            if self._cntrlMode & Pid.Modes.AUTO_READ and self._updateCallback is not None:
-                self._input = self._updateCallback()
-            if self.cntrlMode & Pid.Modes.AUTO_CALC:
-                self.compute()
-                if self._calcDoneCallback is not None:
-                    self._calcDoneCallback(self._error, self._pterm, self._iterm, self._dterm, self._output)
-            if self._cntrlMode & Pid.Modes.AUTO_OUT and \
-               self._outputChangedCallback is not None and \
-               self._output != lastOutput:
-                self._outputChangedCallback(self._output)
-            lastOutput = self._output
-            while time.time() < begin + self._sampleTime:
-                time.sleep(0.05)
-                if self._stopReq.isSet():
-                    break
+            if self._triggerOnSample:
+                self._sampleReady.clear()
+                self._clock.waitEvent(self._sampleReady, self._sampleTime)
+            begin = self._clock.now()
+            self._loopStats.add(begin, deadline, skipped)
+            self.tick()
+            # Absolute deadlines, so the delays do not accumulate. Missed deadlines are skipped, not caught up.
+            deadline += self._sampleTime
+            now = self._clock.now()
+            skipped = 0
+            if now > deadline + self._sampleTime:
+                skipped = int((now - deadline) // self._sampleTime)
+                deadline += skipped * self._sampleTime
+            self._clock.sleepUntil(deadline, self._stopReq)
 
     def start(self):
         if not self._stopReq.isSet():
             self.initialize()
+            self._clock.attach()
             self._updateThread = threading.Thread(target=self._update)
             self._updateThread.start()
 
     def stop(self):
         self._stopReq.set()
         self._updateThread.join()
+
+class PidBatch(object):
+    """
+    M direct acting controllers stepped in lockstep over NumPy arrays, for parameter sweeps. Every parameter may be
+    a scalar or an array of M values. The computation is the same as Pid.compute(): the integral term and the output
+    are clamped to the output limits, and the derivative acts on the measurement. Like in Pid, the integral and
+    derivative coefficients are per second, and scaled by the sample time.
+    """
+
+    def __init__(self, kp, ki, kd, sampleTime=1.0, minOut=0, maxOut=255):
+        try:
+            import numpy  # Only the batches need NumPy, it is not loaded with the live controller
+        except ImportError:
+            raise ImportError("PidBatch needs NumPy")
+        kp, ki, kd, sampleTime, minOut, maxOut = numpy.broadcast_arrays(
+            *[numpy.asarray(val, dtype=float) for val in (kp, ki, kd, sampleTime, minOut, maxOut)])
+        self._kp = kp.ravel().copy()
+        self._ki = (ki * sampleTime).ravel()
+        self._kd = (kd / sampleTime).ravel()
+        self._sampleTime = sampleTime.ravel().copy()
+        self._outMin = minOut.ravel().copy()
+        self._outMax = maxOut.ravel().copy()
+        self._input = numpy.zeros(len(self._kp))
+        self._output = numpy.zeros(len(self._kp))
+        self._iterm = numpy.zeros(len(self._kp))
+        self._lastInput = numpy.zeros(len(self._kp))
+
+    def __len__(self):
+        return len(self._kp)
+
+    @property
+    def sampleTime(self):
+        return self._sampleTime
+
+    @property
+    def output(self):
+        return self._output
+
+    def initialize(self, inputs=None):
+        """
+        Bumpless start, like Pid.initialize(): from the last inputs, or the given ones.
+        """
+        import numpy
+        if inputs is not None:
+            self._input = numpy.array(numpy.broadcast_to(inputs, self._input.shape), dtype=float)
+        self._lastInput = self._input.copy()
+        self._iterm = numpy.clip(self._output, self._outMin, self._outMax)
+
+    def compute(self, inputs, setPoints, mask=None):
+        """
+        Computes the controllers selected by the boolean mask, all of them if it is None. Returns the outputs.
+        """
+        import numpy
+        inputs = numpy.broadcast_to(numpy.asarray(inputs, dtype=float), self._input.shape)
+        setPoints = numpy.broadcast_to(numpy.asarray(setPoints, dtype=float), self._input.shape)
+        if mask is None:
+            mask = numpy.ones(len(self), dtype=bool)
+        error = setPoints[mask] - inputs[mask]
+        dInput = inputs[mask] - self._lastInput[mask]
+        outMin = self._outMin[mask]
+        outMax = self._outMax[mask]
+        iterm = numpy.clip(self._iterm[mask] + self._ki[mask] * error, outMin, outMax)
+        self._iterm[mask] = iterm
+        self._output[mask] = numpy.clip(self._kp[mask] * error + iterm - self._kd[mask] * dInput, outMin, outMax)
+        self._input[mask] = inputs[mask]
+        self._lastInput[mask] = inputs[mask]
+        return self._output
+
+    def run(self, plant, setPoints, period):
+        """
+        Closes the loops over a plant with a temp attribute and a step(outputs) method, e.g. an emulator.OvenModel
+        with an array state. setPoints holds the setpoint of every period, a scalar or M values each. Every
+        controller computes on its own sample time deadlines, on the time grid of the plant's time step, and its
+        output is rounded to an integer like the PWM byte sent to the oven. Returns the plant temperatures at the end
+        of every period, in an array of (periods, M).
+        """
+        import numpy
+        stepsPerPeriod = max(1, int(round(period / plant.timeStep)))
+        timeStep = period / float(stepsPerPeriod)
+        deadlines = numpy.zeros(len(self))
+        pwm = numpy.zeros(len(self))
+        temps = numpy.empty((len(setPoints), len(self)))
+        for k, setPoint in enumerate(setPoints):
+            for j in xrange(stepsPerPeriod):
+                now = (k * stepsPerPeriod + j) * timeStep
+                due = deadlines <= now + timeStep * 1e-6
+                if due.any():
+                    outputs = self.compute(plant.temp, setPoint, due)
+                    pwm[due] = numpy.sign(outputs[due]) * numpy.floor(numpy.abs(outputs[due]) + 0.5)
+                    deadlines[due] += self._sampleTime[due]
+                plant.step(pwm.copy())
+            temps[k] = plant.temp
+        return temps
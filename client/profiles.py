@@ -0,0 +1,133 @@
+import bisect
+import threading
+import collections
+
+import trajectory
+
+class ProfileException(Exception):
+    pass
+
+class ProfileRegistry(object):
+    """
+    Indexed collection of reflow profiles: by name, by alloy and tag, and by peak temperature.
+    Profiles are validated on insert, and their trajectories are compiled lazily on first use.
+    """
+
+    NUMERIC_KEYS = ("rampup", "ts", "Tsmin", "Tsmax", "tl", "Tl", "tp", "Tp", "rampdown")
+
+    def __init__(self, profiles=()):
+        self._byName = collections.OrderedDict()
+        self._byTag = {}
+        self._peakTemps = []
+        self._peakNames = []
+        self._trajectories = {}
+        self._lock = threading.RLock()
+        for profile in profiles:
+            self.add(profile)
+
+    def __len__(self):
+        return len(self._byName)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._byName.values()))
+
+    def __contains__(self, name):
+        return name in self._byName
+
+    @property
+    def default(self):
+        """
+        The first added profile, which is the default one of the settings file.
+        """
+        with self._lock:
+            for profile in self._byName.values():
+                return profile
+
+    def validate(self, profile):
+        name = profile.get("name")
+        if not name:
+            raise ProfileException("Profile without name")
+        for key in self.NUMERIC_KEYS:
+            try:
+                float(profile[key])
+            except (KeyError, TypeError, ValueError):
+                raise ProfileException("Profile %s: missing or invalid %s" % (name, key))
+        if profile["rampup"] <= 0 or profile["rampdown"] <= 0:
+            raise ProfileException("Profile %s: ramp rates must be positive" % name)
+        if min(profile["ts"], profile["tp"]) < 0:
+            raise ProfileException("Profile %s: negative duration" % name)
+        if profile["tl"] <= profile["tp"]:
+            raise ProfileException("Profile %s: tl must be longer than tp" % name)
+        if not profile["Tsmin"] <= profile["Tsmax"] <= profile["Tl"] <= profile["Tp"]:
+            raise ProfileException("Profile %s: temperatures must satisfy Tsmin <= Tsmax <= Tl <= Tp" % name)
+
+    def _tagsOf(self, profile):
+        tags = set(profile.get("tags", ()))
+        if profile.get("alloy"):
+            tags.add(profile["alloy"])
+        return tags
+
+    def add(self, profile):
+        """
+        Validates and inserts the profile, replacing the one with the same name. Raises ProfileException if invalid.
+        """
+        self.validate(profile)
+        with self._lock:
+            name = profile["name"]
+            if name in self._byName:
+                self.remove(name)
+            self._byName[name] = profile
+            for tag in self._tagsOf(profile):
+                self._byTag.setdefault(tag, set()).add(name)
+            idx = bisect.bisect_right(self._peakTemps, profile["Tp"])
+            self._peakTemps.insert(idx, profile["Tp"])
+            self._peakNames.insert(idx, name)
+
+    def remove(self, name):
+        with self._lock:
+            profile = self._byName.pop(name)
+            for tag in self._tagsOf(profile):
+                self._byTag[tag].discard(name)
+                if not self._byTag[tag]:
+                    del self._byTag[tag]
+            idx = self._peakNames.index(name, bisect.bisect_left(self._peakTemps, profile["Tp"]))
+            del self._peakTemps[idx]
+            del self._peakNames[idx]
+            self._trajectories.pop(name, None)
+
+    def get(self, name):
+        return self._byName.get(name)
+
+    def names(self):
+        return list(self._byName)
+
+    def tags(self):
+        return sorted(self._byTag)
+
+    def byTag(self, tag):
+        """
+        Returns the names of the profiles with the given alloy or tag.
+        """
+        return sorted(self._byTag.get(tag, ()))
+
+    def byPeak(self, low, high):
+        """
+        Returns the names of the profiles with peak temperature in [low, high], ordered by the peak temperature.
+        """
+        with self._lock:
+            begin = bisect.bisect_left(self._peakTemps, low)
+            end = bisect.bisect_right(self._peakTemps, high)
+            return self._peakNames[begin:end]
+
+    def trajectory(self, name):
+        """
+        Returns the compiled trajectory of the profile, compiling it on first use.
+        """
+        with self._lock:
+            try:
+                return self._trajectories[name]
+            except KeyError:
+                compiled = trajectory.fromProfile(self._byName[name])
+                self._trajectories[name] = compiled
+                return compiled
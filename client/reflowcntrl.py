@@ -1,19 +1,33 @@
-import time
+import sys
+import socket
 import serial
+import argparse
 import threading
 
 import shh
 import pid
 import uif
-import visualizer
 import storage
 import emulator
-import pidtuner
-import log
+import trajectory
+import frame
+import samplebuffer
+import clocks
+import profiles
+import eventbus
+import adcfilter
+import estimator
 
 class ReflowControl:
 
-    def __init__(self, portName=None, shhCoeffs=None, pidCoeffs=None, profile=None, uRef=None, iRef=None, adcComp=None):
+    TIMEBASE = 0.5
+    LOG_FIELDS = ("ADC", "R", "T", "p", "i", "d", "o")
+
+    def __init__(self, portName=None, shhCoeffs=None, pidCoeffs=None, profile=None, uRef=None, iRef=None, adcComp=None,
+                 clock=None, serialPort=None, headless=False):
+        if clock is None:
+            clock = clocks.RealClock()
+        self._clock = clock
         self._uif = uif.Uif(self)
         self._storage = None
         if not all((portName, shhCoeffs, pidCoeffs, profile, uRef, iRef, adcComp)):
@@ -36,155 +50,344 @@ class ReflowControl:
             pidCoeffs = self._storage.getPidCoeffs()
         if profile is None:
             profile = self._storage.getProfiles()[0]
-        self._uRef = uRef
-        self._iRef = iRef
-        self._adcComp = adcComp
         self._currentProfile = profile
         if self._storage is None:
-            self._profiles = {self._currentProfile}
+            self._profiles = self._buildProfileRegistry((self._currentProfile,))
         else:
-            self._profiles = self._storage.getProfiles()
+            self._profiles = self._buildProfileRegistry(self._storage.getProfiles())
         self._portName = portName
-        self._shhConverter = shh.SteinHaart(*shhCoeffs)
-        self._pid = pid.Pid(self._updateTemp, self._setPwm, pidCoeffs)
+        self._adcConverter = shh.AdcConverter(shhCoeffs, uRef, iRef, adcComp)
+        self._pid = pid.Pid(self._updateTemp, self._pidOutput, pidCoeffs, clock)
         #self._pid.cntrlMode = self._pid.Modes.AUTO_OUT | self._pid.Modes.AUTO_READ #| self._pid.Modes.AUTO_CALC
         self._pid.sampleTime = 0.5
-        self._pidTuner = pidtuner.PidTuner(self._pid)
-        self._serialBuffer = ""
-        if self._portName is not None:
+        self._pidTuner = None
+        self._frameDecoder = frame.LinkDecoder()
+        self._pwm = 0
+        if serialPort is not None:
+            self._serial = serialPort
+        elif self._portName is not None:
             self._serial = serial.Serial(port=self._portName, baudrate=57600)
         else:
-            self._serial = emulator.FakeSerial()
+            self._serial = emulator.FakeSerial(self._adcConverter, clock=clock)
             self._uif.msg("!!! No available serial port found. Using emulated input data !!!")
-        self._adcValue = 350
+        self._adcSamples = samplebuffer.SampleBuffer(timeFunc=clock.now)
+        self._adcFilter = adcfilter.FilterChain(timeFunc=clock.now)
+        self._filteredSeq = 0
+        if self._storage is not None:
+            try:
+                self.setAdcFilter(self._storage.getAdcFilter())
+            except ValueError as e:
+                self._uif.msg("Invalid adcfilter, not filtering: %s" % e)
+        self._estimator = None
+        self._latency = self._pid.latencyStats
         self._readAdcThread = None
-        self._adcLock = threading.Lock()
         self._stopAdcReq = threading.Event()
         self._stopBakeReq = threading.Event()
         self._startDraw = threading.Event()
         self._baking = threading.Event()
+        self._headless = headless
         self._graph = None
         self._new = False
+        self._bakeRecord = []
         self._pid.attachCallback(self._pid.CallbackType.CALC, self._pidCalcDone)
-        self._logger = log.Logger()
-        self._logger._enabled = False#True
-
-    def _convertToSteps(self, begin, end, duration, timebase):
-        #duration *= 1.4
-        delta = end - begin
-        stepNo = int(round(duration / timebase))
-        stepNo = 1 if stepNo == 0 else stepNo
-        stepWidth = delta / float(stepNo)
-        steps = [begin + i * stepWidth for i in range(stepNo)]
-        steps[-1] = end
-        return steps
-
-    def _profileToTt(self, profile, timebase=0.5):
-        steps = []
-        ambient = 50
-        # Preamble
-        steps.extend(self._convertToSteps(50, 50, 30, timebase))
-        # Ambient to preheat
-        rampupTime = (profile["Tsmin"] - ambient) / profile["rampup"]
-        steps.extend(self._convertToSteps(ambient, profile["Tsmin"], rampupTime, timebase))
-        # Preheat
-        steps.extend(self._convertToSteps(profile["Tsmin"], profile["Tsmax"], profile["ts"], timebase))
-        # Preheat to Liquidous
-        tlTotpTime = tpTotlTime = (profile["tl"] - profile["tp"]) / 2.0
-        deltaTsmaxTl = profile["Tl"] - profile["Tsmax"]
-        deltaTlTp = profile["Tp"] - profile["Tl"]
-        slopeTsmaxTl = slopeTlTp = deltaTlTp / float(tlTotpTime)
-        durTsmaxTl = deltaTsmaxTl * (slopeTsmaxTl * 2.0)
-        steps.extend(self._convertToSteps(profile["Tsmax"], profile["Tl"], durTsmaxTl, timebase))
-        # Liquidous to Peak
-        steps.extend(self._convertToSteps(profile["Tl"], profile["Tp"], tlTotpTime, timebase))
-        # Reflow
-        steps.extend(self._convertToSteps(profile["Tp"], profile["Tp"], profile["tp"], timebase))
-        # Back to Liquidous
-        steps.extend(self._convertToSteps(profile["Tp"], profile["Tl"], tpTotlTime, timebase))
-        # Cool down
-        coolDowmTime = (profile["Tl"] - ambient) / profile["rampdown"]
-        steps.extend(self._convertToSteps(profile["Tl"], ambient, coolDowmTime, timebase))
-        timestamps = tuple(timebase * i for i in range(len(steps)))
-        return (timestamps, steps)
+        self._logger = None
+        self._logSubscriber = None
+        self._telemetry = None
+        self._telemetrySubscriber = None
+        self._sample = None
+        self._bus = eventbus.EventBus()
+        self._bus.subscribe(eventbus.SAMPLE, "uif", self._dispSample, 1)
+        if self._storage is not None:
+            self._storage.watch(self._settingsChanged, errorCallback=self._uif.msg)
 
     def _updateTemp(self):
+        if self._latency.enabled:
+            # The reader thread marks every new batch, keep the arrival of the one consumed
+            self._latency.copyMark("sample", "consumed")
+            self._latency.addSince("age", "consumed")
         adcValue = self._getAdcValue()
-        ktyRes = ((self._uRef * adcValue) / (1023.0 * self._adcComp)) / self._iRef
-        ktyTemp = self._shhConverter.rToTempCelsius(ktyRes)
-        self._uif.disp("in", ("ADC", adcValue), ("R", "%.2f" % ktyRes), ("T", "%.2f" % ktyTemp), self._new)
-        self._logger.new({"ADC": adcValue, "R": "%.2f" % ktyRes, "T": "%.2f" % ktyTemp})
-        self._graph.update(ktyTemp)
+        ktyRes = self._adcConverter.toResistance(adcValue)
+        ktyTemp = self._adcConverter.toCelsius(adcValue)
+        self._sample = eventbus.Sample(self._clock.now(), adcValue, ktyRes, ktyTemp, self._new)
         self._new = False
-        return ktyTemp
+        est = self._estimator
+        if est is not None:
+            self._sample.estimate = est.update(ktyTemp, self._pwm, self._sample.time)
+            self._sample.rate = est.rate
+        self._pid.inputRate = self._sample.rate
+        if not self._pid.cntrlMode & self._pid.Modes.AUTO_CALC:
+            self._sample.setPoint = self._pid.setPoint
+            self._sample.output = self._pid.output
+            self._bus.publish(eventbus.SAMPLE, self._sample)
+        return self._sample.estimate
 
     def _pidCalcDone(self, err, pterm, iterm, dterm, output):
-        self._uif.disp("pid", ("e", "%.2f" % err), ("p", "%.2f" % pterm), ("i", "%.2f" % iterm), ("d", "%.2f" % -dterm), ("o", "%.2f" % output))
-        self._logger.extend({"p": pterm, "i": iterm, "d": dterm, "o": output})
+        sample = self._sample
+        if sample is not None:
+            sample.setPoint = self._pid.setPoint
+            sample.error = err
+            sample.pterm = pterm
+            sample.iterm = iterm
+            sample.dterm = dterm
+            sample.output = output
+            self._bus.publish(eventbus.SAMPLE, sample)
+            self._sample = None
+        if self._baking.isSet():
+            # The measured temperature, the oven model must not be fitted on the estimates
+            self._bakeRecord.append((sample.temp if sample is not None else self._pid.inputx, output))
+
+    def _logSample(self, sample):
+        self._logger.new({"ADC": sample.adc, "R": "%.2f" % sample.resistance, "T": "%.2f" % sample.temp,
+                          "p": sample.pterm, "i": sample.iterm, "d": sample.dterm, "o": sample.output})
+
+    def _dispSample(self, sample):
+        self._uif.disp("in", ("ADC", sample.adc), ("R", "%.2f" % sample.resistance), ("T", "%.2f" % sample.temp),
+                       sample.fresh)
+        self._uif.disp("pid", ("e", "%.2f" % sample.error), ("p", "%.2f" % sample.pterm), ("i", "%.2f" % sample.iterm),
+                       ("d", "%.2f" % -sample.dterm), ("o", "%.2f" % sample.output))
+        self._uif.disp("out", "PWM: ", sample.output)
+        if sample.rate is not None:
+            self._uif.disp("est", ("E", "%.2f" % sample.estimate), ("dT/dt", "%.2f" % sample.rate))
+
+    def _plotSample(self, sample):
+        self._graph.update(sample.temp, sample.time)
+
+    def enableLog(self, enable=True):
+        """
+        Logs every PID cycle to a new log file, until disabled.
+        """
+        if enable and self._logSubscriber is None:
+            import log
+            self._logger = log.Logger(self.LOG_FIELDS)
+            self._logSubscriber = self._bus.subscribe(eventbus.SAMPLE, "log", self._logSample, 4096,
+                                                      eventbus.DropPolicy.NEWEST)
+        elif not enable and self._logSubscriber is not None:
+            self._bus.unsubscribe(eventbus.SAMPLE, self._logSubscriber)
+            self._logSubscriber = None
+            self._logger.close()
+            self._logger = None
+
+    def startTelemetry(self, addresses):
+        """
+        Starts streaming every PID cycle to the telemetry clients, on the addresses like "tcp:127.0.0.1:7070" or
+        "unix:/tmp/reflowcntrl.sock". Stops the server running first, so its addresses can be reused. Raises
+        ValueError or socket.error if an address can not be listened on.
+        """
+        import telemetry
+        self.stopTelemetry()
+        server = telemetry.TelemetryServer(addresses)
+        server.start()
+        self._telemetry = server
+        self._telemetrySubscriber = self._bus.subscribe(eventbus.SAMPLE, "telemetry", server.publish, 256)
+
+    def stopTelemetry(self):
+        if self._telemetry is not None:
+            self._bus.unsubscribe(eventbus.SAMPLE, self._telemetrySubscriber)
+            self._telemetry.stop()
+            self._telemetry = None
+            self._telemetrySubscriber = None
+
+    def _openGraph(self):
+        """
+        Starts the plotting process on first use, which imports matplotlib. Headless there is nothing to plot on.
+        """
+        if self._graph is None:
+            import visualizer
+            if self._headless:
+                self._graph = visualizer.NullVisualizer()
+            else:
+                self._graph = visualizer.Visualizer(self._clock)
+                self._bus.subscribe(eventbus.SAMPLE, "graph", self._plotSample, 1024)
+        self._graph.init(self._refData)
+        return self._graph
 
     def _setPwm(self, toValue):
+        self._pwm = int(round(toValue))
+        if self._frameDecoder.protocol == 2:
+            data = frame.encodeCommand(frame.CMD_PWM, self._pwm)
+        else:
+            data = chr(self._pwm)
         try:
-            self._serial.write(chr(int(round(toValue))))
+            self._serial.write(data)
         except serial.SerialException:
             pass
-        self._uif.disp("out", "PWM: ", toValue)
 
-    def _sflush(self):
-        self._serial.read(self._serial.inWaiting())
+    def _pidOutput(self, output):
+        self._setPwm(output)
+        if self._latency.enabled:
+            self._latency.addSince("endToEnd", "consumed", clear=True)
 
     def _getAdcValue(self):
-        with self._adcLock:
-            adcValue = self._adcValue
-        return adcValue
+        """
+        Returns the latest ADC value, filtered if there are filters. The filters take every sample received since the
+        last call.
+        """
+        if not len(self._adcFilter):
+            return self._adcSamples.last(350)
+        times, values, self._filteredSeq = self._adcSamples.since(self._filteredSeq)
+        self._adcFilter.process(values)
+        return self._adcFilter.latest if self._adcFilter.latest is not None else self._adcSamples.last(350)
+
+    def setAdcFilter(self, specs):
+        """
+        Replaces the ADC filters with the ones of the specs, e.g. ["median:5", "iir:0.3"]. Raises ValueError if a spec
+        is invalid.
+        """
+        chain = adcfilter.FilterChain.fromSpecs(specs, self._clock.now)
+        self._filteredSeq = self._adcSamples.seq
+        self._adcFilter = chain
+
+    def _ovenModel(self):
+        """
+        Returns the oven's model dict of sysid.FopdtFit.model(): the one fitted for the port, or the emulated oven's.
+        Returns None if there is none.
+        """
+        if self._storage is not None:
+            try:
+                import sysid
+                fit = sysid.loadFit(self._storage, self._portName)
+                if fit is not None:
+                    return fit.model()
+            except (ImportError, ValueError):
+                pass
+        if isinstance(self._serial, emulator.FakeSerial):
+            import simtuner
+            gain, deadTime, tau = simtuner.modelToFopdt({})
+            return {"gain": gain, "tau": tau, "deadTime": deadTime, "ambient": emulator.OvenModel().ambient}
+
+    def enableEstimator(self, enable=True):
+        """
+        Feeds the PID with the temperature and heating rate of a ThermalEstimator on the oven's model, instead of the
+        measured temperature. Raises ValueError if there is no usable model of the oven.
+        """
+        if not enable:
+            self._estimator = None
+            self._pid.inputRate = None
+            return
+        model = self._ovenModel()
+        if model is None:
+            raise ValueError("No oven model, bake once to fit one, or run sysid.py")
+        self._estimator = estimator.ThermalEstimator.fromModel(model, self._pid.sampleTime)
+
+    def _lookAhead(self):
+        """
+        The setpoints are applied this many timebases early, as the estimate is ahead of the measurement.
+        """
+        est = self._estimator
+        return int(round(est.horizon / self.TIMEBASE)) if est is not None else 0
 
     def _readAdc(self):
-        frameLen = 3
+        try:
+            self._readAdcLoop()
+        finally:
+            self._clock.detach()
+
+    def _readAdcLoop(self):
         try:
             while not self._stopAdcReq.isSet():
-                self._sflush()
-                self._serialBuffer = self._serial.read(frameLen)
-                while ord(self._serialBuffer[0]) != 0xFF or ord(self._serialBuffer[2]) & 0xF0 != 0x00:
-                    self._serialBuffer = self._serialBuffer[1:] + self._serial.read(1)
-                    assert(len(self._serialBuffer) == frameLen)
-                adcValue = ord(self._serialBuffer[2]) << 8
-                adcValue += ord(self._serialBuffer[1])
-                with self._adcLock:
-                    self._adcValue = adcValue
-                self._new = True
+                waiting = self._serial.inWaiting()
+                self._processSerialData(self._serial.read(max(waiting, self._frameDecoder.FRAME_LEN)))
         except serial.SerialException, e:
             if self._stopAdcReq.isSet() and "Bad file descriptor" in e.message:
                 pass  # The port was closed in self._stopAdc(). Hopefully.
             else:
                 raise
 
+    def _processSerialData(self, data):
+        protocol = self._frameDecoder.protocol
+        adcValues = self._frameDecoder.feed(data)
+        if self._frameDecoder.protocol != protocol:
+            self._setPwm(self._pwm)  # The firmware ignores legacy PWM bytes once switched to v2
+        if adcValues:
+            if self._latency.enabled:
+                self._latency.mark("sample")
+            self._adcSamples.extend(adcValues)
+            self._new = True
+            self._pid.notifySample()
+
     def _stopAdc(self):
         self._stopAdcReq.set()
         self._serial.close()  # Intentionally raises exception in readAdcThread
         self._readAdcThread.join()
 
     def _initProfile(self):
-        self._refData = self._profileToTt(self._currentProfile)
+        if self._currentProfile["name"] in self._profiles:
+            self._trajectory = self._profiles.trajectory(self._currentProfile["name"])
+        else:
+            self._trajectory = trajectory.fromProfile(self._currentProfile)
+        self._refData = self._trajectory.steps(self.TIMEBASE)
         #timestamps, steps = self._refData
         #l = (len(steps)) // 3
         #x  =timestamps[l:]
         #self._refData = (x, steps[:len(x)])
-        self._graph.init(self._refData)
+        if self._graph is not None:
+            self._graph.init(self._refData)
 
     def loadProfile(self, name):
         if self._baking.isSet():
             self._uif.msg("Can not load profile while reflow is in progress.")
             return
-        found = False
-        for profile in self._profiles:
-            if profile["name"] == name:
-                self._currentProfile = profile
-                found = True
-                break
-        if found:
+        profile = self._profiles.get(name)
+        if profile is not None:
+            self._currentProfile = profile
             self._initProfile()
         else:
             self._uif.msg("Profile %s not found." % name)
 
+    def _buildProfileRegistry(self, profileList):
+        registry = profiles.ProfileRegistry()
+        for profile in profileList or ():
+            try:
+                registry.add(profile)
+            except profiles.ProfileException as e:
+                self._uif.msg("Skipped invalid profile: %s" % e.message)
+        return registry
+
+    def _settingsChanged(self, settings, changedKeys):
+        if "pidcoeffs" in changedKeys and settings.pidCoeffs is not None:
+            self._pid.kp, self._pid.ki, self._pid.kd = settings.pidCoeffs
+        if "shhcoeffs" in changedKeys and settings.shhCoeffs is not None:
+            self._adcConverter.setShhCoeffs(*settings.shhCoeffs)
+        if changedKeys & set(("uref", "iref", "adccomp")):
+            self._adcConverter.setReference(settings.uRef, settings.iRef, settings.adcComp)
+        if "adcfilter" in changedKeys:
+            try:
+                self.setAdcFilter(settings.adcFilter)
+            except ValueError as e:
+                self._uif.msg("Invalid adcfilter: %s" % e)
+        if "telemetry" in changedKeys:
+            try:
+                if settings.telemetry:
+                    self.startTelemetry(settings.telemetry)
+                else:
+                    self.stopTelemetry()
+            except (ValueError, socket.error) as e:
+                self._uif.msg("Could not start telemetry: %s" % e)
+        if "profile" in changedKeys and settings.profiles is not None:
+            self._profiles = self._buildProfileRegistry(settings.profiles)
+            if not self._baking.isSet():
+                self.loadProfile(self._currentProfile["name"])
+        self._uif.msg("Settings reloaded: %s" % ", ".join(sorted(changedKeys)))
+
+    def linkStats(self):
+        return self._frameDecoder.counters
+
+    def _sendCommand(self, cmd, arg):
+        try:
+            self._serial.write(frame.encodeCommand(cmd, arg))
+        except serial.SerialException:
+            pass
+
+    def configureLink(self, decimation=None, samplesPerFrame=None):
+        """
+        Sets how many ADC reads the firmware averages into one sample, and how many samples it sends in a protocol
+        v2 frame.
+        """
+        if decimation is not None:
+            self._sendCommand(frame.CMD_DECIMATION, decimation)
+        if samplesPerFrame is not None:
+            self._sendCommand(frame.CMD_SAMPLES, samplesPerFrame)
+
     def savePidCoeffs(self):
         pidCoeffs = (self._pid.kp, self._pid.ki, self._pid.kd)
         try:
@@ -196,10 +399,12 @@ class ReflowControl:
         if not self._baking.isSet():
             self._baking.set()
             self._stopBakeReq.clear()
-            self._graph.init(self._refData)
+            graph = self._openGraph()
+            self._bakeRecord = []
+            self._clock.attach()
             self._bakingProcessThread = threading.Thread(target=self._bakingProcess)
             self._bakingProcessThread.start()
-            self._graph.enableLive()
+            graph.enableLive()
 
     def stopBake(self):
         if self._baking.isSet() and not self._stopBakeReq.isSet():
@@ -207,47 +412,134 @@ class ReflowControl:
             self._bakingProcessThread.join()
             self._stopBakeReq.clear()
 
+    def _applySetPoint(self, setPoint):
+        self._pid._setpoint = setPoint + 7
+
     def _bakingProcess(self):
-        self._uif.msg("Reflow started")
-        for setPoint in self._refData[1]:
-            if self._stopBakeReq.isSet():
-                break
-            self._pid._setpoint = setPoint + 7
-            time.sleep(0.5)
-        self._pid.setPoint = 0
-        self._graph.disableLive()
-        self._baking.clear()
-        self._uif.msg("Reflow finished")
+        try:
+            self._uif.msg("Reflow started")
+            begin = self._clock.now()
+            timestamps, setPoints = self._refData
+            for i, timestamp in enumerate(timestamps):
+                if self._stopBakeReq.isSet():
+                    break
+                self._applySetPoint(setPoints[min(i + self._lookAhead(), len(setPoints) - 1)])
+                self._clock.sleepUntil(begin + timestamp + self.TIMEBASE, self._stopBakeReq)
+            self._pid.setPoint = 0
+            self._graph.disableLive()
+            self._baking.clear()
+            self._uif.msg("Reflow finished")
+            if not self._stopBakeReq.isSet():
+                self._updateOvenModel()
+        finally:
+            self._clock.detach()
+
+    def _updateOvenModel(self):
+        """
+        Refines the oven's fitted model with the bake just finished.
+        """
+        if self._storage is None or not self._bakeRecord:
+            return
+        try:
+            import sysid
+            fit = sysid.loadFit(self._storage, self._portName)
+            if fit is None:
+                fit = sysid.FopdtFit(self._pid.sampleTime)
+            fit.update(*zip(*self._bakeRecord))
+            sysid.saveFit(self._storage, self._portName, fit)
+            self._uif.msg("Oven model: " + " ".join("%s: %.3g" % item for item in sorted(fit.model().items())))
+        except (ImportError, ValueError, storage.StorageException) as e:
+            self._uif.msg("Could not update the oven model: %s" % e)
+
+    def _getPidTuner(self):
+        if self._pidTuner is None:
+            import pidtuner
+            self._pidTuner = pidtuner.PidTuner(self._pid)
+        return self._pidTuner
 
     def autoTune(self, mode):
-        if mode == "s":
-            self._pidTuner.test_controller_step_response()
-        elif mode == "b":
-            self._pidTuner.test_controller_bang_bang_response()
+        try:
+            if mode == "s":
+                self._getPidTuner().test_controller_step_response()
+            elif mode == "b":
+                self._getPidTuner().test_controller_bang_bang_response()
+            elif mode == "o":
+                self._tuneOffline()
+        except ImportError as e:
+            self._uif.msg("Tuning is not available: %s" % e)
+
+    def _tuneOffline(self):
+        import simtuner
+        modelParams = {}
+        if self._storage is not None:
+            try:
+                import sysid
+                modelParams = sysid.modelParamsFor(self._storage, self._portName)
+            except ImportError:
+                pass
+        results = simtuner.OfflineTuner(modelParams, self._trajectory).tune()
+        score, error, overshoot, coeffs = results[0]
+        self._uif.msg("Best: p %g i %g d %g, error %.2f, overshoot %.2f" % (coeffs + (error, overshoot)))
+        self._pid.kp, self._pid.ki, self._pid.kd = coeffs
+        self.savePidCoeffs()
 
     def draw(self, enable=False):
         if enable:
-            self._graph.init(self._refData)
-            self._graph.enableLive()
-        else:
+            self._openGraph().enableLive()
+        elif self._graph is not None:
             self._graph.disableLive()
 
     def start(self):
-        self._setPwm(0)
-        self._readAdcThread = threading.Thread(target=self._readAdc)
-        self._graph = visualizer.Visualizer()
-        self._initProfile()
-        self._readAdcThread.start()
-        self._pid.start()
+        self._clock.attach()  # Hold the clock until every timed thread is started
+        try:
+            self._sendCommand(frame.CMD_PROTOCOL, 2)  # Older firmware keeps sending legacy frames
+            self._setPwm(0)
+            self._clock.attach()
+            self._readAdcThread = threading.Thread(target=self._readAdc)
+            self._initProfile()
+            self._readAdcThread.start()
+            self._pid.start()
+        finally:
+            self._clock.detach()
+        if self._telemetry is None and self._storage is not None and self._storage.getTelemetry():
+            try:
+                self.startTelemetry(self._storage.getTelemetry())
+            except (ValueError, socket.error) as e:
+                self._uif.msg("Could not start telemetry: %s" % e)
         self._uif.start()
 
     def stop(self):
         self.stopBake()
         self._pid.stop()
-        self._graph.stop()
+        if self._graph is not None:
+            self._graph.stop()
         self._stopAdc()
+        self._bus.stop()
+        if self._logger is not None:
+            self._logger.close()
+        if self._telemetry is not None:
+            self._telemetry.stop()
+        if self._storage is not None:
+            self._storage.stopWatching()
         self._uif.stop()
 
-if __name__ == '__main__':
-    controller = ReflowControl()
+def main(args):
+    parser = argparse.ArgumentParser(description="Controls the reflow oven from the console.")
+    parser.add_argument("--headless", action="store_true",
+                        help="no plotting process, for boards without a display; the console works as usual")
+    parser.add_argument("--log", action="store_true", help="log every PID cycle from the start")
+    parser.add_argument("--telemetry", action="append", metavar="ADDRESS",
+                        help="stream every PID cycle on tcp:host:port or unix:path, instead of the settings' addresses")
+    args = parser.parse_args(args)
+    controller = ReflowControl(headless=args.headless)
+    if args.log:
+        controller.enableLog()
+    if args.telemetry:
+        try:
+            controller.startTelemetry(args.telemetry)
+        except (ValueError, socket.error) as e:
+            parser.error("Could not start telemetry: %s" % e)
     controller.start()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
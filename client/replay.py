@@ -0,0 +1,187 @@
+"""
+Replays recorded ADC data through the full pipeline of ReflowControl as fast as the CPU allows: frame decoding,
+temperature conversion, Pid ticks and setpoint playback of the default profile, with no wall-clock sleeps. The
+outputs are compared to golden files, so changes can be regression checked against past bakes.
+Usage: replay.py [--adc-log] [--update] [--sample-rate N] recording [recording ...]
+A recording is a raw serial capture, or with --adc-log a log.Logger file with an ADC column. The golden file of a
+recording is the recording's name with a .golden suffix.
+"""
+
+import sys
+import argparse
+
+import clocks
+import frame
+import storage
+import reflowcntrl
+
+OUTPUT_FIELDS = ("t", "ADC", "T", "spt", "o")
+TOLERANCE = 1e-6
+
+class ReplaySerial(object):
+    """
+    Serial port serving the recorded bytes. Writes are recorded as the PWM values sent to the oven: the PWM
+    commands, and like the legacy firmware, every other byte that is not part of a valid command.
+    """
+
+    def __init__(self, data):
+        self._data = data
+        self._pos = 0
+        self.pwm = 0
+        self._pwmBeforeCommand = 0
+        self._parser = frame.CommandParser()
+        self._open = True
+
+    @property
+    def exhausted(self):
+        return self._pos >= len(self._data)
+
+    def inWaiting(self):
+        return len(self._data) - self._pos
+
+    def read(self, n):
+        val = self._data[self._pos:self._pos + n]
+        self._pos += len(val)
+        return val
+
+    def write(self, b):
+        for byte in bytearray(b):
+            if self._parser.idle:
+                self._pwmBeforeCommand = self.pwm
+            self.pwm = byte
+            command = self._parser.push(byte)
+            if command is not None:
+                cmd, arg = command
+                self.pwm = arg if cmd == frame.CMD_PWM else self._pwmBeforeCommand
+
+    def close(self):
+        self._open = False
+
+def loadCapture(fileName):
+    with open(fileName, "rb") as file:
+        return file.read()
+
+def loadAdcLog(fileName):
+    """
+    Converts the ADC column of a log to frames, one per sample.
+    """
+    frames = []
+    with open(fileName) as file:
+        idx = file.readline().strip().split(";").index("ADC")
+        for line in file:
+            try:
+                adcValue = int(line.split(";")[idx])
+            except (IndexError, ValueError):
+                continue
+            frames.append("\xFF" + chr(adcValue & 0xFF) + chr((adcValue >> 8) & 0x03))
+    return "".join(frames)
+
+class Replay(object):
+
+    def __init__(self, data, samplesPerTick, settings=None):
+        if settings is None:
+            settings = storage.Storage()
+        self._serial = ReplaySerial(data)
+        self._clock = clocks.VirtualClock()
+        self._controller = reflowcntrl.ReflowControl(
+            portName="replay", shhCoeffs=settings.getShhCoeffs(), pidCoeffs=settings.getPidCoeffs(),
+            profile=settings.getProfiles()[0], uRef=settings.getUref(), iRef=settings.getIref(),
+            adcComp=settings.getAdcComp(), clock=self._clock, serialPort=self._serial, headless=True)
+        self._samplesPerTick = samplesPerTick
+
+    def _readTick(self):
+        """
+        Feeds the controller until samplesPerTick samples are decoded, or the recording runs out. A legacy frame
+        takes FRAME_LEN bytes per sample and a protocol v2 frame more than 2, so no read takes more samples than
+        needed.
+        """
+        controller = self._controller
+        decoder = controller._frameDecoder
+        target = controller._adcSamples.seq + self._samplesPerTick
+        while not self._serial.exhausted and controller._adcSamples.seq < target:
+            bytesPerSample = decoder.FRAME_LEN if decoder.protocol == 1 else 2
+            controller._processSerialData(self._serial.read((target - controller._adcSamples.seq) * bytesPerSample))
+
+    def run(self):
+        """
+        Returns the output rows, one per Pid tick, until the recording runs out.
+        """
+        controller = self._controller
+        controller._initProfile()
+        controller._pid.initialize()
+        sampleTime = controller._pid.sampleTime
+        setPoints = controller._refData[1]
+        rows = []
+        tick = 0
+        while not self._serial.exhausted:
+            self._clock.sleepUntil(tick * sampleTime)
+            self._readTick()
+            controller._applySetPoint(setPoints[min(tick, len(setPoints) - 1)])
+            controller._pid.tick()
+            rows.append((self._clock.now(), controller._getAdcValue(), controller._pid.inputx,
+                         controller._pid.setPoint, self._serial.pwm))
+            tick += 1
+        controller._bus.stop()
+        if controller._storage is not None:
+            controller._storage.stopWatching()
+        return rows
+
+def writeRows(fileName, rows):
+    with open(fileName, "w") as file:
+        file.write(";".join(OUTPUT_FIELDS) + "\n")
+        for row in rows:
+            file.write(";".join(repr(val) for val in row) + "\n")
+
+def readRows(fileName):
+    with open(fileName) as file:
+        file.readline()
+        return [tuple(float(val) for val in line.strip().split(";")) for line in file if line.strip()]
+
+def diffRows(rows, goldenRows):
+    """
+    Returns the description of the first difference, or None if the rows match.
+    """
+    if len(rows) != len(goldenRows):
+        return "%d rows instead of %d" % (len(rows), len(goldenRows))
+    for i, (row, goldenRow) in enumerate(zip(rows, goldenRows)):
+        for field, val, goldenVal in zip(OUTPUT_FIELDS, row, goldenRow):
+            if abs(val - goldenVal) > TOLERANCE * max(1.0, abs(goldenVal)):
+                return "row %d: %s is %r instead of %r" % (i, field, val, goldenVal)
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Replays recordings through the controller, diffs to golden files.")
+    parser.add_argument("--adc-log", action="store_true", help="recordings are logs with an ADC column")
+    parser.add_argument("--update", action="store_true", help="write the golden files instead of checking them")
+    parser.add_argument("--sample-rate", type=float, default=None,
+                        help="frames per second in a raw capture, default is the full rate of 57600 baud")
+    parser.add_argument("recordings", nargs="+")
+    args = parser.parse_args(args)
+    settings = storage.Storage()
+    failed = 0
+    for fileName in args.recordings:
+        if args.adc_log:
+            data = loadAdcLog(fileName)
+            samplesPerTick = 1
+        else:
+            data = loadCapture(fileName)
+            sampleRate = args.sample_rate if args.sample_rate is not None else 57600 / 10.0 / 3
+            samplesPerTick = max(1, int(round(sampleRate * reflowcntrl.ReflowControl.TIMEBASE)))
+        rows = Replay(data, samplesPerTick, settings).run()
+        goldenName = fileName + ".golden"
+        if args.update:
+            writeRows(goldenName, rows)
+            print("%s: %d rows written" % (goldenName, len(rows)))
+            continue
+        try:
+            difference = diffRows(rows, readRows(goldenName))
+        except IOError as e:
+            difference = str(e)
+        if difference is not None:
+            failed += 1
+            print("%s: FAILED, %s" % (fileName, difference))
+        else:
+            print("%s: ok, %d rows" % (fileName, len(rows)))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,126 @@
+import time
+import array
+import threading
+
+class SampleBuffer(object):
+    """
+    Fixed capacity ring buffer of timestamped ADC samples.
+    Values are stored in an array('H'), timestamps in an array('d'), so the memory use does not grow with the run
+    time. Timestamps are forced to be monotonic. Every appended sample gets a sequence number, which can be used to
+    fetch the samples arrived since a previous call.
+    """
+
+    def __init__(self, capacity=8192, timeFunc=time.time):
+        self._capacity = capacity
+        self._values = array.array("H", [0]) * capacity
+        self._times = array.array("d", [0.0]) * capacity
+        self._seq = 0
+        self._lastTime = float("-inf")
+        self._timeFunc = timeFunc
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def seq(self):
+        """
+        Sequence number of the next sample, i.e. the number of samples appended so far.
+        """
+        return self._seq
+
+    def __len__(self):
+        return min(self._seq, self._capacity)
+
+    def _append(self, value, timestamp):
+        idx = self._seq % self._capacity
+        self._values[idx] = value
+        self._times[idx] = timestamp
+        self._seq += 1
+
+    def append(self, value, timestamp=None):
+        self.extend((value,), timestamp)
+
+    def extend(self, values, timestamp=None):
+        """
+        Appends a batch of samples received together, all of them get the same timestamp.
+        """
+        if timestamp is None:
+            timestamp = self._timeFunc()
+        with self._lock:
+            timestamp = max(timestamp, self._lastTime)
+            self._lastTime = timestamp
+            for value in values:
+                self._append(value, timestamp)
+
+    def _range(self, begin, end):
+        """
+        Returns the (timestamps, values) lists of the samples with sequence numbers in [begin, end).
+        Must be called with the lock held.
+        """
+        begin = max(begin, end - self._capacity, 0)
+        b = begin % self._capacity
+        e = b + (end - begin)
+        if e <= self._capacity:
+            return self._times[b:e].tolist(), self._values[b:e].tolist()
+        e -= self._capacity
+        return (self._times[b:].tolist() + self._times[:e].tolist(),
+                self._values[b:].tolist() + self._values[:e].tolist())
+
+    def last(self, default=None):
+        with self._lock:
+            if not self._seq:
+                return default
+            return self._values[(self._seq - 1) % self._capacity]
+
+    def latest(self, n):
+        """
+        Returns the (timestamps, values) lists of the last n samples.
+        """
+        with self._lock:
+            return self._range(self._seq - n, self._seq)
+
+    def since(self, seq):
+        """
+        Returns the (timestamps, values, nextSeq) of the samples appended since the given sequence number.
+        Samples already overwritten are silently skipped.
+        """
+        with self._lock:
+            times, values = self._range(seq, self._seq)
+            return times, values, self._seq
+
+    def window(self, seconds, now=None):
+        """
+        Returns the (timestamps, values) lists of the samples of the last given seconds.
+        """
+        if now is None:
+            now = self._timeFunc()
+        begin = now - seconds
+        with self._lock:
+            n = 0
+            available = len(self)
+            while n < available and self._times[(self._seq - n - 1) % self._capacity] >= begin:
+                n += 1
+            return self._range(self._seq - n, self._seq)
+
+    def average(self, seconds, now=None):
+        """
+        Returns the mean of the samples of the last given seconds, e.g. of the last PID period, or None if there is
+        none.
+        """
+        values = self.window(seconds, now)[1]
+        if not values:
+            return None
+        return sum(values) / float(len(values))
+
+    def decimated(self, n, factor):
+        """
+        Returns the (timestamps, values) lists of the last n block averages of factor samples each.
+        The timestamp of a block is the timestamp of its last sample.
+        """
+        times, values = self.latest(n * factor)
+        skip = len(values) % factor
+        times = times[skip + factor - 1::factor]
+        values = [sum(values[i:i + factor]) / float(factor) for i in range(skip, len(values), factor)]
+        return times, values
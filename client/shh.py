@@ -1,4 +1,5 @@
 import math
+import bisect
 
 class SteinHaart:
 
@@ -11,6 +12,10 @@ class SteinHaart:
         self._C = C
         self._D = D
 
+    @property
+    def coeffs(self):
+        return (self._A, self._B, self._C, self._D)
+
     def rToTempKelvin(self, resInOhm):
         if resInOhm <= 0:
             t = 0
@@ -22,3 +27,94 @@ class SteinHaart:
     def rToTempCelsius(self, resInOhm):
         t = self.rToTempKelvin(resInOhm) - 273.15
         return t
+
+class AdcConverter(object):
+    """
+    Converts raw ADC readings of the KTY sensor to resistance and temperature.
+    The ADC is 10 bits wide, so the whole uRef/iRef/adcComp and Steinhart-Hart chain is precomputed into lookup
+    tables, which are rebuilt whenever a coefficient changes.
+    """
+
+    ADC_MAX = 1023
+
+    def __init__(self, shhCoeffs, uRef, iRef, adcComp):
+        self._shh = SteinHaart(*shhCoeffs)
+        self._uRef = uRef
+        self._iRef = iRef
+        self._adcComp = adcComp
+        self._buildTables()
+
+    def _buildTables(self):
+        rTable = []
+        tTable = []
+        for adcValue in range(self.ADC_MAX + 1):
+            res = ((self._uRef * adcValue) / (float(self.ADC_MAX) * self._adcComp)) / self._iRef
+            rTable.append(res)
+            tTable.append(self._shh.rToTempCelsius(res))
+        self._rTable = tuple(rTable)
+        self._tTable = tuple(tTable)
+        self._arrays = {}
+
+    @property
+    def shhCoeffs(self):
+        return self._shh.coeffs
+
+    def setShhCoeffs(self, A, B, C, D):
+        self._shh.setCoeffs(A, B, C, D)
+        self._buildTables()
+
+    def setReference(self, uRef=None, iRef=None, adcComp=None):
+        if uRef is not None:
+            self._uRef = uRef
+        if iRef is not None:
+            self._iRef = iRef
+        if adcComp is not None:
+            self._adcComp = adcComp
+        self._buildTables()
+
+    def _lookup(self, table, adcValue):
+        try:
+            return table[adcValue]
+        except TypeError:
+            # Fractional value from the ADC filters: linear interpolation between the neighbouring codes
+            idx = max(0, min(int(adcValue), self.ADC_MAX - 1))
+            return table[idx] + (table[idx + 1] - table[idx]) * (adcValue - idx)
+
+    def toResistance(self, adcValue):
+        return self._lookup(self._rTable, adcValue)
+
+    def toCelsius(self, adcValue):
+        return self._lookup(self._tTable, adcValue)
+
+    def toAdc(self, tempInCelsius):
+        """
+        Inverse conversion, returns the ADC code whose temperature is the closest to the given one from below.
+        """
+        idx = bisect.bisect_right(self._tTable, tempInCelsius, 1) - 1
+        return max(0, min(idx, self.ADC_MAX))
+
+    def _convertBatch(self, table, adcValues):
+        # NumPy is imported on the first batch only, the live conversions do not need it
+        try:
+            import numpy
+        except ImportError:
+            return [self._lookup(table, adcValue) for adcValue in adcValues]
+        adcValues = numpy.asarray(adcValues)
+        if adcValues.dtype.kind == "f":
+            # Fractional values from the ADC filters, interpolated like in _lookup()
+            return numpy.interp(adcValues, numpy.arange(len(table)), table)
+        try:
+            array = self._arrays[table]
+        except KeyError:
+            array = self._arrays[table] = numpy.array(table)
+        return array[adcValues.astype(numpy.intp)]
+
+    def convert(self, adcValues):
+        """
+        Batch conversion of a sequence of ADC codes to Celsius degrees.
+        Returns a NumPy array if NumPy is available, a list otherwise.
+        """
+        return self._convertBatch(self._tTable, adcValues)
+
+    def convertResistance(self, adcValues):
+        return self._convertBatch(self._rTable, adcValues)
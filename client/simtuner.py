@@ -0,0 +1,153 @@
+"""
+Offline PID tuning: simulates the controller against an oven model for a grid of Kp/Ki/Kd candidates, plus the
+ones the pypid tuning rules suggest, in lockstep with NumPy or else in a process pool, and scores how well each one
+follows a profile.
+Usage: simtuner.py [--profile name] [--model heaterPower thermalMass lossCoeff deadTime] [--save]
+Without --model the model fitted by sysid.py for the oven is used, if there is one.
+"""
+
+import sys
+import argparse
+import itertools
+import multiprocessing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import pid
+import emulator
+import storage
+import profiles
+
+SAMPLE_TIME = 0.5
+MODEL_TIME_STEP = 0.05
+OVERSHOOT_WEIGHT = 5.0
+
+def modelToFopdt(modelParams):
+    """
+    Returns the first order plus dead time parameters (process gain in Celsius per PWM unit, dead time, decay time)
+    of an OvenModel.
+    """
+    model = emulator.OvenModel(**modelParams)
+    processGain = model.heaterPower / (model.lossCoeff * model.PWM_MAX)
+    return processGain, model.deadTime, model.thermalMass / model.lossCoeff
+
+def simulate(modelParams, coeffs, setPoints, sampleTime=SAMPLE_TIME):
+    """
+    Runs a Pid with the given coefficients against the model, returns the list of temperatures at every sample.
+    """
+    model = emulator.OvenModel(timeStep=MODEL_TIME_STEP, **modelParams)
+    stepsPerSample = int(round(sampleTime / MODEL_TIME_STEP))
+    pwm = [0]
+
+    def setPwm(output):
+        pwm[0] = int(round(output))
+    controller = pid.Pid(lambda: model.temp, setPwm, coeffs)
+    controller.sampleTime = sampleTime
+    controller.initialize()
+    temps = []
+    for setPoint in setPoints:
+        controller.setPoint = setPoint
+        controller.tick()
+        for i in range(stepsPerSample):
+            model.step(pwm[0])
+        temps.append(model.temp)
+    return temps
+
+def simulateBatch(modelParams, candidates, setPoints, sampleTime=SAMPLE_TIME):
+    """
+    Same as simulate(), for all the candidate coefficients at once with a PidBatch. Returns the temperatures in an
+    array of (samples, candidates).
+    """
+    kps, kis, kds = numpy.array(candidates, dtype=float).reshape(-1, 3).T
+    model = emulator.OvenModel(timeStep=MODEL_TIME_STEP, **modelParams)
+    controllers = pid.PidBatch(kps, kis, kds, sampleTime)
+    controllers.initialize()
+    return controllers.run(model, setPoints, sampleTime)
+
+def score(setPoints, temps):
+    """
+    Returns (score, mean absolute tracking error, overshoot above the profile's peak); lower score is better.
+    """
+    error = sum(abs(setPoint - temp) for setPoint, temp in zip(setPoints, temps)) / len(setPoints)
+    overshoot = max(0.0, max(temps) - max(setPoints))
+    return error + OVERSHOOT_WEIGHT * overshoot, error, overshoot
+
+def _evaluate(args):
+    modelParams, coeffs, setPoints = args
+    return score(setPoints, simulate(modelParams, coeffs, setPoints)) + (coeffs,)
+
+def ruleCandidates(modelParams):
+    """
+    Returns the coefficients suggested by the Ziegler-Nichols, Cohen-Coon and Wang-Juang-Chan step response rules,
+    or an empty list if pypid is not available.
+    """
+    try:
+        import pypid.rules
+    except ImportError:
+        return []
+    processGain, deadTime, decayTime = modelToFopdt(modelParams)
+    candidates = []
+    for responseFn, modes in ((pypid.rules.ziegler_nichols_step_response, ("P", "PI", "PID")),
+                              (pypid.rules.cohen_coon_step_response, ("P", "PI", "PID")),
+                              (pypid.rules.wang_juang_chan_step_response, ("PID",))):
+        for mode in modes:
+            p, i, d = responseFn(process_gain=processGain, dead_time=deadTime, decay_time=decayTime, mode=mode)
+            candidates.append((p, p / i, p * d))  # pypid gives integral and derivative times
+    return candidates
+
+def gridCandidates(kps, kis, kds):
+    return list(itertools.product(kps, kis, kds))
+
+class OfflineTuner(object):
+
+    def __init__(self, modelParams, profileTrajectory, processes=None):
+        self._modelParams = dict(modelParams)
+        self._setPoints = profileTrajectory.steps(SAMPLE_TIME)[1]
+        self._processes = processes
+
+    def evaluate(self, candidates):
+        """
+        Simulates every candidate, returns the (score, error, overshoot, coeffs) tuples sorted by score. With NumPy
+        the candidates run in lockstep in a PidBatch, otherwise one by one in a process pool.
+        """
+        if numpy is not None:
+            temps = simulateBatch(self._modelParams, candidates, self._setPoints)
+            return sorted(score(self._setPoints, temps[:, i].tolist()) + (tuple(coeffs),)
+                          for i, coeffs in enumerate(candidates))
+        jobs = [(self._modelParams, tuple(coeffs), self._setPoints) for coeffs in candidates]
+        pool = multiprocessing.Pool(self._processes)
+        try:
+            results = pool.map(_evaluate, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        return sorted(results)
+
+    def tune(self, kps=(1, 2, 5, 10, 20, 40), kis=(0, 0.01, 0.05, 0.1, 0.5), kds=(0, 5, 10, 20, 50, 100)):
+        return self.evaluate(ruleCandidates(self._modelParams) + gridCandidates(kps, kis, kds))
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Tunes the PID offline, by simulation against an oven model.")
+    parser.add_argument("--profile", help="name of the profile to track, the default one if omitted")
+    parser.add_argument("--model", nargs=4, type=float, metavar=("HEATER", "MASS", "LOSS", "DEADTIME"),
+                        help="oven model: heater power (W), thermal mass (J/K), loss (W/K), dead time (s)")
+    parser.add_argument("--save", action="store_true", help="save the best coefficients to the settings file")
+    args = parser.parse_args(args)
+    import sysid
+    settings = storage.Storage()
+    registry = profiles.ProfileRegistry(settings.getProfiles())
+    name = args.profile if args.profile is not None else registry.default["name"]
+    modelParams = sysid.modelParamsFor(settings, settings.getSerial())
+    if args.model is not None:
+        modelParams = dict(zip(("heaterPower", "thermalMass", "lossCoeff", "deadTime"), args.model))
+    results = OfflineTuner(modelParams, registry.trajectory(name)).tune()
+    for result in results[:10]:
+        print("score %.2f  error %.2f  overshoot %.2f  p %g i %g d %g" % (result[:3] + tuple(result[3])))
+    if args.save:
+        settings.save("pidcoeffs", results[0][3])
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
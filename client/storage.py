@@ -1,104 +1,90 @@
 import os
+import tempfile
 import threading
 
 class StorageException(Exception):
     pass
 
-class Storage():
+class Settings(object):
+    """
+    Typed model of the settings file, parsed once per file version. Treat it as read-only, it is shared between the
+    callers.
+    """
 
-    def __init__(self):
-        self._fileName = ".reflowcntrlrc"
-        self._entries = {}
-        self._fileLock = threading.Lock()
-        self.load()
+    PROFILE_KEYS = ("name", "rampup", "ts", "Tsmin", "Tsmax", "tl", "Tl", "tp", "Tp", "rampdown")
+    PROFILE_OPTIONAL_KEYS = ("alloy", "tags")
 
-    def load(self):
-        if not os.access(self._fileName, os.R_OK):
-            raise StorageException("Could not open settings file: %s" % self._fileName)
-        with self._fileLock:
-            self._entries.clear()
-            with open(self._fileName) as file:
-                for line in file:
-                    line = line.strip()
-                    if not line or line.startswith("#"):
-                        continue
-                    key, value = line.split(" ", 1)
-                    key = key.lower()
-                    try:
-                        self._entries[key].append(value)
-                    except KeyError:
-                        self._entries[key] = [value]
+    def __init__(self, entries):
+        self.entries = entries
+        self.serials = entries.get("serial", [])
+        self.uRef = self._scalar("uref")
+        self.iRef = self._scalar("iref")
+        self.adcComp = self._scalar("adccomp")
+        self.adcFilter = self._first(self.getVal("adcfilter")) or []
+        self.telemetry = self._first(self.getVal("telemetry")) or []
+        self.shhCoeffs = self._first(self._getNumeric("shhcoeffs", 4))
+        self.pidCoeffs = self._first(self._getNumeric("pidcoeffs", 3))
+        self.profiles = self._parseProfiles()
+        self.models = self._parseModels()
+
+    def _parseModels(self):
+        models = {}
+        for rawVals in self.getVal("model") or ():
+            try:
+                models[rawVals[0]] = map(float, rawVals[1:])
+            except (IndexError, ValueError):
+                pass
+        return models
+
+    def _first(self, vals):
+        if vals is not None:
+            return vals[0]
 
-    def _toFloat(self, value):
-        return float(value)
+    def _scalar(self, key):
+        val = self._getNumeric(key, 1)
+        if val is not None:
+            return val[0][0]
 
     def _getNumeric(self, key, expectedLen):
         numVals = []
-        rawVals = self._getVal(key, expectedLen)
+        rawVals = self.getVal(key, expectedLen)
         try:
             for vals in rawVals:
-                numVals.append(map(self._toFloat, vals))
+                numVals.append(map(float, vals))
             return numVals
         except (ValueError, TypeError):
             pass
 
-    def _getVal(self, key, expectedLen):
+    def getVal(self, key, expectedLen=None):
         vals = []
-        with self._fileLock:
-            try:
-                for rawVals in self._entries[key]:
-                    rawVals = rawVals.split(" ")
-                    assert(len(rawVals) == expectedLen)
-                    vals.append(rawVals)
-                return vals
-            except (KeyError, AssertionError):
-                pass
-
-    def getSerial(self):
-        with self._fileLock:
-            for serial in self._entries.get("serial", []):
-                if os.access(serial, os.W_OK | os.R_OK):
-                    return serial
-
-    def getPidCoeffs(self):
-        val = self._getNumeric("pidcoeffs", 3)
-        if val is not None:
-            return val[0]
-
-    def getShhCoeffs(self):
-        val = self._getNumeric("shhcoeffs", 4)
-        if val is not None:
-            return val[0]
-
-    def getUref(self):
-        val = self._getNumeric("uref", 1)
-        if val is not None:
-            return val[0][0]
-
-    def getIref(self):
-        val = self._getNumeric("iref", 1)
-        if val is not None:
-            return val[0][0]
-
-    def getAdcComp(self):
-        val = self._getNumeric("adccomp", 1)
-        if val is not None:
-            return val[0][0]
+        try:
+            for rawVals in self.entries[key]:
+                rawVals = rawVals.split()
+                assert(expectedLen is None or len(rawVals) == expectedLen)
+                vals.append(rawVals)
+            return vals
+        except (KeyError, AssertionError):
+            pass
 
-    def getProfiles(self):
+    def _parseProfiles(self):
         def splitAtColon(val):
             vals = val.split(":", 1)
             if len(vals) != 2:
                 vals = ("", "")
             return vals
         profiles = []
-        profileKeys = ("name", "rampup", "ts", "Tsmin", "Tsmax", "tl", "Tl", "tp", "Tp", "rampdown")
-        rawProfiles = self._getVal("profile", 10)
+        rawProfiles = self.getVal("profile")
         if rawProfiles is not None:
             for rawProfile in rawProfiles:
                 profile = {}
                 for key, value in map(splitAtColon, rawProfile):
-                    if key not in profileKeys:
+                    if key == "alloy":
+                        profile[key] = value
+                        continue
+                    elif key == "tags":
+                        profile[key] = tuple(tag for tag in value.split(",") if tag)
+                        continue
+                    elif key not in self.PROFILE_KEYS:
                         continue
                     try:
                         profile[key] = float(value)
@@ -106,7 +92,7 @@ class Storage():
                         if key == "name":
                             profile[key] = value
                 missing = False
-                for key in profileKeys:
+                for key in self.PROFILE_KEYS:
                     if key not in profile:
                         missing = True
                         break
@@ -120,7 +106,150 @@ class Storage():
         if profiles:
             return profiles
 
-    def save(self, key, values, append=False):
+    def diff(self, other):
+        """
+        Returns the set of keys whose values differ in the other settings.
+        """
+        return set(key for key in set(self.entries) | set(other.entries)
+                   if self.entries.get(key) != other.entries.get(key))
+
+class Storage():
+    """
+    Access to the settings file. The file is parsed into a Settings model, which is cached until the file's mtime
+    changes. Saves write a temp file and rename it over the original, so a crash never leaves a half written file.
+    """
+
+    def __init__(self, fileName=".reflowcntrlrc"):
+        self._fileName = fileName
+        self._settings = None
+        self._mtime = None
+        self._fileLock = threading.Lock()
+        self._watcherThread = None
+        self._stopWatchReq = threading.Event()
+        self.load()
+
+    def _mtimeOf(self):
+        try:
+            stat = os.stat(self._fileName)
+            return (stat.st_mtime, stat.st_size)
+        except OSError:
+            return None
+
+    def load(self):
+        if not os.access(self._fileName, os.R_OK):
+            raise StorageException("Could not open settings file: %s" % self._fileName)
+        with self._fileLock:
+            try:
+                self._load()
+            except (ValueError, IOError, OSError) as e:
+                raise StorageException("Could not read settings file: %s" % e)
+
+    def _load(self):
+        entries = {}
+        mtime = self._mtimeOf()
+        with open(self._fileName) as file:
+            for line in file:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                try:
+                    key, value = line.split(" ", 1)
+                except ValueError:
+                    raise ValueError("Malformed line, no value: %s" % line)
+                key = key.lower()
+                try:
+                    entries[key].append(value)
+                except KeyError:
+                    entries[key] = [value]
+        self._settings = Settings(entries)
+        self._mtime = mtime
+
+    def _reload(self):
+        """
+        Returns the current Settings, reloaded if the file changed. Raises ValueError, IOError or OSError if the file
+        can not be read or parsed, then the last good settings are kept, and the next call tries again.
+        """
+        with self._fileLock:
+            mtime = self._mtimeOf()
+            if mtime is not None and mtime != self._mtime:
+                self._load()
+            return self._settings
+
+    @property
+    def settings(self):
+        """
+        The current Settings, reloaded if the file changed since the last access. If the file can not be read or
+        parsed, the last good ones.
+        """
+        try:
+            return self._reload()
+        except (ValueError, IOError, OSError):
+            return self._settings
+
+    def _getVal(self, key, expectedLen):
+        return self.settings.getVal(key, expectedLen)
+
+    def getSerial(self):
+        for serial in self.settings.serials:
+            if os.access(serial, os.W_OK | os.R_OK):
+                return serial
+
+    def getPidCoeffs(self):
+        return self.settings.pidCoeffs
+
+    def getShhCoeffs(self):
+        return self.settings.shhCoeffs
+
+    def getUref(self):
+        return self.settings.uRef
+
+    def getIref(self):
+        return self.settings.iRef
+
+    def getAdcComp(self):
+        return self.settings.adcComp
+
+    def getAdcFilter(self):
+        """
+        Returns the list of the ADC filter specs, e.g. ["median:5", "iir:0.3"].
+        """
+        return self.settings.adcFilter
+
+    def getTelemetry(self):
+        """
+        Returns the list of the addresses the telemetry server listens on, e.g. ["tcp:127.0.0.1:7070"].
+        """
+        return self.settings.telemetry
+
+    def getProfiles(self):
+        return self.settings.profiles
+
+    def getModel(self, portName):
+        """
+        Returns the numeric values of the oven model saved for the serial port, or None.
+        """
+        return self.settings.models.get(portName)
+
+    def _writeAtomic(self, content):
+        dirName = os.path.dirname(os.path.abspath(self._fileName))
+        fd, tempName = tempfile.mkstemp(prefix=".reflowcntrlrc.", dir=dirName)
+        try:
+            with os.fdopen(fd, "w") as file:
+                file.write(content)
+                file.flush()
+                os.fsync(file.fileno())
+            if os.path.exists(self._fileName):
+                os.chmod(tempName, os.stat(self._fileName).st_mode & 0o777)
+            os.rename(tempName, self._fileName)
+        except:
+            os.unlink(tempName)
+            raise
+
+    def save(self, key, values, append=False, match=None):
+        """
+        Replaces the lines of the key with the values, or appends them after the existing ones. With match given,
+        only the lines whose first value equals to it are replaced. Lines of a new key are added to the end.
+        """
         if not os.access(self._fileName, os.R_OK | os.W_OK):
             raise StorageException("Could not open settings file: %s" % self._fileName)
         key = key.lower()
@@ -128,9 +257,9 @@ class Storage():
         lines = []
         stage = 0
         with self._fileLock:
-            with open(self._fileName, "r+") as file:
+            with open(self._fileName, "r") as file:
                 for line in file.read().split("\n"):
-                    if line.startswith(key + " "):
+                    if line.startswith(key + " ") and (match is None or line.split()[1:2] == [match]):
                         stage = 1
                         if not append:
                             lines.append(newValue)
@@ -141,11 +270,55 @@ class Storage():
                             stage = 2
                             lines.append(newValue)
                         lines.append(line)
-                if append and stage < 2:
+                if stage == 0 or (append and stage < 2):
                     lines.append(newValue)
-                file.seek(0)
-                file.truncate()
-                file.write("\n".join(lines))
+            try:
+                self._writeAtomic("\n".join(lines))
+            except (IOError, OSError) as e:
+                raise StorageException("Could not write settings file: %s" % e)
+            self._load()
+
+    def _watch(self, callback, interval, errorCallback):
+        if errorCallback is None:
+            def errorCallback(msg):
+                print(msg)
+        settings = self.settings
+        lastError = None
+        while not self._stopWatchReq.wait(interval):
+            try:
+                newSettings = self._reload()
+            except (ValueError, IOError, OSError) as e:
+                if str(e) != lastError:  # Reported once, the file is retried on every poll
+                    lastError = str(e)
+                    errorCallback("Settings not reloaded, keeping the last good ones: %s" % e)
+                continue
+            lastError = None
+            if newSettings is not settings:
+                changed = settings.diff(newSettings)
+                settings = newSettings
+                if changed:
+                    try:
+                        callback(newSettings, changed)
+                    except Exception as e:
+                        errorCallback("Could not apply the settings: %s" % e)
+
+    def watch(self, callback, interval=1.0, errorCallback=None):
+        """
+        Starts a thread checking the file every interval seconds. On change calls callback(settings, changedKeys).
+        Errors of reading the file or of the callback are passed to errorCallback(message), printed by default, and
+        the watching goes on.
+        """
+        if self._watcherThread is None:
+            self._stopWatchReq.clear()
+            self._watcherThread = threading.Thread(target=self._watch, args=(callback, interval, errorCallback))
+            self._watcherThread.daemon = True
+            self._watcherThread.start()
+
+    def stopWatching(self):
+        if self._watcherThread is not None:
+            self._stopWatchReq.set()
+            self._watcherThread.join()
+            self._watcherThread = None
 
 
 if __name__ == '__main__':
@@ -159,4 +332,4 @@ if __name__ == '__main__':
     print(s.getAdcComp())
     print(s.getProfiles())
     #s.save("profile", [2.0, 23.1, 1], True)
-    pass
\ No newline at end of file
+    pass
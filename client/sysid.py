@@ -0,0 +1,164 @@
+"""
+System identification of the oven from recorded bakes.
+Fits the discrete first order plus dead time model
+    T[k+1] = a * T[k] + b * pwm[k - d] + c
+by least squares, for every dead time d up to a limit, and keeps the best one. The fit is kept as sufficient
+statistics, so it can be refined incrementally with every new bake, and saved per serial port in the settings file.
+Usage: sysid.py [--port name] [--reset] [--save] logfile [logfile ...]
+"""
+
+import sys
+import math
+import argparse
+import numpy
+
+import emulator
+import storage
+
+SAMPLE_TIME = 0.5
+MAX_DELAY = 60
+EMULATOR_PORT = "emulator"
+
+def readLog(fileName, fields=("T", "o")):
+    """
+    Reads the given columns of a log.Logger file into float arrays, rows with missing values are dropped.
+    """
+    with open(fileName) as file:
+        header = file.readline().strip().split(";")
+        idxs = [header.index(field) for field in fields]
+        rows = []
+        for line in file:
+            vals = line.rstrip("\n").split(";")
+            try:
+                rows.append([float(vals[idx]) for idx in idxs])
+            except (IndexError, ValueError):
+                continue
+    data = numpy.array(rows, dtype=float).reshape(-1, len(fields))
+    return [data[:, i] for i in range(len(fields))]
+
+class FopdtFit(object):
+    """
+    Least squares fit of the first order plus dead time model. For every dead time candidate it accumulates X'X,
+    X'y and y'y, where a row of X is (T[k], pwm[k - d], 1) and y is T[k + 1].
+    """
+
+    def __init__(self, sampleTime=SAMPLE_TIME, maxDelay=MAX_DELAY):
+        self.sampleTime = sampleTime
+        self._delays = range(maxDelay + 1)
+        self._xtx = numpy.zeros((len(self._delays), 3, 3))
+        self._xty = numpy.zeros((len(self._delays), 3))
+        self._yty = numpy.zeros(len(self._delays))
+        self._n = numpy.zeros(len(self._delays))
+
+    @classmethod
+    def fromSaved(cls, values):
+        """
+        Restores a fit saved by toSaved(). Only the saved dead time is kept, the later updates refine the others.
+        """
+        sampleTime, delay, n = values[:3]
+        fit = cls(sampleTime, int(delay))
+        fit._delays = [int(delay)]
+        fit._xtx = numpy.array(values[3:12]).reshape(1, 3, 3)
+        fit._xty = numpy.array(values[12:15]).reshape(1, 3)
+        fit._yty = numpy.array(values[15:16])
+        fit._n = numpy.array([n])
+        return fit
+
+    def toSaved(self):
+        idx = self._bestIdx()
+        return ([self.sampleTime, self._delays[idx], self._n[idx]] + self._xtx[idx].ravel().tolist() +
+                self._xty[idx].tolist() + [self._yty[idx]])
+
+    def update(self, temps, pwms):
+        """
+        Adds a recorded bake: the temperatures and the PWM outputs computed from them at every sample.
+        """
+        temps = numpy.asarray(temps, dtype=float)
+        pwms = numpy.asarray(pwms, dtype=float)
+        for i, delay in enumerate(self._delays):
+            k = numpy.arange(delay, len(temps) - 1)
+            if not len(k):
+                continue
+            x = numpy.column_stack((temps[k], pwms[k - delay], numpy.ones(len(k))))
+            y = temps[k + 1]
+            self._xtx[i] += x.T.dot(x)
+            self._xty[i] += x.T.dot(y)
+            self._yty[i] += y.dot(y)
+            self._n[i] += len(k)
+
+    def _solve(self, idx):
+        coeffs = numpy.linalg.lstsq(self._xtx[idx], self._xty[idx], rcond=-1)[0]
+        residual = self._yty[idx] - 2 * coeffs.dot(self._xty[idx]) + coeffs.dot(self._xtx[idx]).dot(coeffs)
+        return coeffs, residual / max(self._n[idx], 1)
+
+    def _bestIdx(self):
+        candidates = [i for i in range(len(self._delays)) if self._n[i] > 3]
+        if not candidates:
+            raise ValueError("Not enough samples to fit the model")
+        return min(candidates, key=lambda i: self._solve(i)[1])
+
+    def model(self):
+        """
+        Returns the fitted model as a dict of process gain (Celsius per PWM unit), time constant, dead time,
+        ambient temperature and mean squared residual.
+        """
+        idx = self._bestIdx()
+        (a, b, c), mse = self._solve(idx)
+        if not 0 < a < 1:
+            raise ValueError("Fitted model is not stable (a = %g)" % a)
+        return {"gain": b / (1 - a), "tau": -self.sampleTime / math.log(a),
+                "deadTime": self._delays[idx] * self.sampleTime, "ambient": c / (1 - a), "mse": mse}
+
+def toOvenModelParams(model, heaterPower=None):
+    """
+    Converts a fitted model to emulator.OvenModel parameters. Only the ratios are identifiable, so the heater power
+    is taken as given, or the model's default.
+    """
+    if heaterPower is None:
+        heaterPower = emulator.OvenModel().heaterPower
+    lossCoeff = heaterPower / (model["gain"] * emulator.OvenModel.PWM_MAX)
+    return {"heaterPower": heaterPower, "lossCoeff": lossCoeff, "thermalMass": model["tau"] * lossCoeff,
+            "deadTime": model["deadTime"], "ambient": model["ambient"]}
+
+def portKey(portName):
+    return EMULATOR_PORT if portName is None else portName
+
+def loadFit(settings, portName):
+    values = settings.getModel(portKey(portName))
+    if values is not None:
+        return FopdtFit.fromSaved(values)
+
+def saveFit(settings, portName, fit):
+    settings.save("model", [portKey(portName)] + ["%r" % value for value in fit.toSaved()], match=portKey(portName))
+
+def modelParamsFor(settings, portName):
+    """
+    Returns the OvenModel parameters of the oven on the port, or an empty dict if there is no usable saved model.
+    """
+    fit = loadFit(settings, portName)
+    try:
+        return toOvenModelParams(fit.model()) if fit is not None else {}
+    except ValueError:
+        return {}
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Fits an oven model to recorded bake logs.")
+    parser.add_argument("--port", help="serial port of the oven, the one of the settings file if omitted")
+    parser.add_argument("--reset", action="store_true", help="ignore the saved fit, start from scratch")
+    parser.add_argument("--save", action="store_true", help="save the fit to the settings file")
+    parser.add_argument("logs", nargs="+", help="log files of bakes")
+    args = parser.parse_args(args)
+    settings = storage.Storage()
+    portName = args.port if args.port is not None else settings.getSerial()
+    fit = None if args.reset else loadFit(settings, portName)
+    if fit is None:
+        fit = FopdtFit()
+    for fileName in args.logs:
+        fit.update(*readLog(fileName))
+    model = fit.model()
+    print(" ".join("%s: %g" % item for item in sorted(model.items())))
+    if args.save:
+        saveFit(settings, portName, fit)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,333 @@
+"""
+Local telemetry server: streams the PID cycles as compact binary records to any number of subscribers over TCP or
+Unix sockets, for dashboards and recorders. A single thread serves every connection with select(), the control loop
+only pays for putting the record on the event bus.
+On connect the server sends HEADER, then RECORDs, little endian. A subscriber may send text lines:
+    decimate n    sends only every n-th record, 1 sends all
+Every subscriber has a bounded buffer, and when it does not keep up, its oldest records are dropped. The gaps show
+in the sequence numbers.
+Usage: telemetry.py [--decimate n] address
+Prints the records streamed by a running controller. Addresses are like tcp:127.0.0.1:7070 or unix:/tmp/reflow.sock.
+"""
+
+import os
+import sys
+import stat
+import errno
+import struct
+import socket
+import select
+import argparse
+import threading
+import collections
+
+MAGIC = "RFTM"
+VERSION = 1
+RECORD_FIELDS = ("seq", "time", "adc", "temp", "setPoint", "pterm", "iterm", "dterm", "pwm")
+RECORD = struct.Struct("<IdHfffffB")
+HEADER = struct.Struct("<4sBB")  # MAGIC, VERSION, RECORD.size
+
+def parseAddress(address):
+    """
+    Returns the (family, address) of "tcp:host:port" or "unix:path". Raises ValueError if invalid.
+    """
+    kind, sep, rest = address.partition(":")
+    if kind == "tcp":
+        host, sep, port = rest.rpartition(":")
+        try:
+            return socket.AF_INET, (host or "127.0.0.1", int(port))
+        except ValueError:
+            raise ValueError("Invalid port in %s" % address)
+    if kind == "unix" and rest:
+        return socket.AF_UNIX, rest
+    raise ValueError("Invalid address %s, expected tcp:host:port or unix:path" % address)
+
+def encodeSample(seq, sample):
+    return RECORD.pack(seq & 0xFFFFFFFF, sample.time, min(max(int(round(sample.adc)), 0), 0xFFFF), sample.temp,
+                       sample.setPoint, sample.pterm, sample.iterm, sample.dterm,
+                       min(max(int(round(sample.output)), 0), 255))
+
+def decodeRecords(data):
+    """
+    Returns the dicts of the whole records in data, and the rest of the data.
+    """
+    count = len(data) // RECORD.size
+    records = [dict(zip(RECORD_FIELDS, RECORD.unpack_from(data, i * RECORD.size))) for i in range(count)]
+    return records, data[count * RECORD.size:]
+
+class _Connection(object):
+    """
+    One subscriber. offer() is called from the publishing thread, everything else from the server's thread.
+    """
+
+    SEND_BATCH = 64
+
+    def __init__(self, sock, peer, bufferRecords):
+        self.sock = sock
+        self.peer = peer
+        self._queue = collections.deque(maxlen=bufferRecords)
+        self._out = HEADER.pack(MAGIC, VERSION, RECORD.size)
+        self._headerLeft = HEADER.size
+        self._recordBytesSent = 0
+        self._in = ""
+        self._decimation = 1
+        self._count = 0
+        self.dropped = 0
+
+    def offer(self, record):
+        self._count += 1
+        if (self._count - 1) % self._decimation:
+            return
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped += 1
+        self._queue.append(record)
+
+    @property
+    def wantsWrite(self):
+        return bool(self._out or self._queue)
+
+    def write(self):
+        if not self._out:
+            batch = []
+            while len(batch) < self.SEND_BATCH:
+                try:
+                    batch.append(self._queue.popleft())
+                except IndexError:
+                    break
+            self._out = "".join(batch)
+        sentBytes = self.sock.send(self._out)
+        self._out = self._out[sentBytes:]
+        headerBytes = min(sentBytes, self._headerLeft)
+        self._headerLeft -= headerBytes
+        self._recordBytesSent += sentBytes - headerBytes
+
+    @property
+    def sent(self):
+        """
+        The records sent completely.
+        """
+        return self._recordBytesSent // RECORD.size
+
+    def read(self):
+        """
+        Handles the received commands. Returns False if the subscriber closed the connection.
+        """
+        data = self.sock.recv(4096)
+        if not data:
+            return False
+        lines = (self._in + data).split("\n")
+        self._in = lines.pop()[-256:]
+        for line in lines:
+            args = line.split()
+            if len(args) == 2 and args[0] == "decimate":
+                try:
+                    self._decimation = max(1, int(args[1]))
+                except ValueError:
+                    pass
+        return True
+
+    @property
+    def counters(self):
+        return {"decimation": self._decimation, "sent": self.sent, "dropped": self.dropped,
+                "pending": len(self._queue)}
+
+class TelemetryServer(object):
+    """
+    Listens on the addresses, and sends every published eventbus.Sample to the subscribers connected. Raises
+    socket.error or ValueError if an address can not be listened on.
+    """
+
+    BUFFER_RECORDS = 256
+
+    def __init__(self, addresses, bufferRecords=BUFFER_RECORDS):
+        self._bufferRecords = bufferRecords
+        self._listeners = []
+        self._unixPaths = []
+        self._connections = ()
+        self._seq = 0
+        self._wakePending = False
+        self._stopReq = threading.Event()
+        self._wakeRead, self._wakeWrite = socket.socketpair()
+        self._wakeWrite.setblocking(False)
+        try:
+            for address in addresses:
+                self._listen(*parseAddress(address))
+        except Exception:
+            self._close()
+            raise
+        self._thread = threading.Thread(target=self._serve, name="telemetry")
+        self._thread.daemon = True
+
+    def _listen(self, family, address):
+        if family == socket.AF_UNIX and os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+            os.unlink(address)  # Left behind by a previous run
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            if family == socket.AF_INET:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(address)
+            sock.listen(5)
+            sock.setblocking(False)
+        except Exception:
+            sock.close()
+            raise
+        if family == socket.AF_UNIX:
+            fileStat = os.stat(address)
+            self._unixPaths.append((address, fileStat.st_dev, fileStat.st_ino))
+        self._listeners.append(sock)
+
+    @property
+    def addresses(self):
+        """
+        The addresses listened on, with the actual ports if port 0 was given.
+        """
+        return [sock.getsockname() for sock in self._listeners]
+
+    def start(self):
+        self._thread.start()
+
+    def publish(self, sample):
+        """
+        Queues the sample to every subscriber. Does not block on the sockets.
+        """
+        seq = self._seq
+        self._seq += 1
+        connections = self._connections
+        if not connections:
+            return
+        record = encodeSample(seq, sample)
+        for connection in connections:
+            connection.offer(record)
+        self._wake()
+
+    def _wake(self):
+        if self._wakePending:
+            return
+        self._wakePending = True
+        try:
+            self._wakeWrite.send("\0")
+        except socket.error:
+            pass
+
+    def subscribers(self):
+        """
+        Returns the (peer, counters) pairs of the connected subscribers.
+        """
+        return [(connection.peer, connection.counters) for connection in self._connections]
+
+    def _accept(self, listener):
+        try:
+            sock, peer = listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(False)
+        if listener.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            peer = "%s:%d" % peer
+        else:
+            peer = "unix:%s" % listener.getsockname()
+        self._connections += (_Connection(sock, peer, self._bufferRecords),)
+
+    def _drop(self, connection):
+        self._connections = tuple(conn for conn in self._connections if conn is not connection)
+        connection.sock.close()
+
+    def _serve(self):
+        try:
+            while not self._stopReq.isSet():
+                connections = self._connections
+                readers = self._listeners + [self._wakeRead] + [conn.sock for conn in connections]
+                writers = [conn.sock for conn in connections if conn.wantsWrite]
+                try:
+                    readable, writable = select.select(readers, writers, [])[:2]
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if self._wakeRead in readable:
+                    self._wakePending = False  # Records offered from now on wake again
+                    self._wakeRead.recv(4096)
+                for listener in self._listeners:
+                    if listener in readable:
+                        self._accept(listener)
+                for connection in connections:
+                    try:
+                        if connection.sock in readable and not connection.read():
+                            self._drop(connection)
+                        elif connection.sock in writable:
+                            connection.write()
+                    except socket.error as e:
+                        if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                            self._drop(connection)
+        finally:
+            self._close()
+
+    def _close(self):
+        for connection in self._connections:
+            connection.sock.close()
+        self._connections = ()
+        for sock in self._listeners:
+            sock.close()
+        self._listeners = []
+        for path, device, inode in self._unixPaths:
+            try:
+                fileStat = os.stat(path)
+                if (fileStat.st_dev, fileStat.st_ino) == (device, inode):  # Not replaced by another server
+                    os.unlink(path)
+            except OSError:
+                pass
+        self._unixPaths = []
+        self._wakeRead.close()
+        self._wakeWrite.close()
+
+    def stop(self):
+        """
+        Closes every connection and stops listening.
+        """
+        if self._thread.is_alive():
+            self._stopReq.set()
+            self._wake()
+            self._thread.join()
+        elif self._listeners:
+            self._close()
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Prints the telemetry records of a running controller.")
+    parser.add_argument("--decimate", type=int, default=1, help="print every n-th record only")
+    parser.add_argument("address", help="tcp:host:port or unix:path")
+    args = parser.parse_args(args)
+    family, address = parseAddress(args.address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(address)
+    if args.decimate > 1:
+        sock.sendall("decimate %d\n" % args.decimate)
+    data = ""
+    while len(data) < HEADER.size:
+        chunk = sock.recv(HEADER.size - len(data))
+        if not chunk:
+            return 1
+        data += chunk
+    magic, version, recordSize = HEADER.unpack(data)
+    if magic != MAGIC or version != VERSION or recordSize != RECORD.size:
+        print("Unsupported telemetry stream: %r version %d" % (magic, version))
+        return 1
+    print(";".join(RECORD_FIELDS))
+    data = ""
+    try:
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            records, data = decodeRecords(data + chunk)
+            for record in records:
+                print("%(seq)d;%(time).3f;%(adc)d;%(temp).2f;%(setPoint).2f;%(pterm).2f;%(iterm).2f;%(dterm).2f;"
+                      "%(pwm)d" % record)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
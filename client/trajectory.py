@@ -0,0 +1,147 @@
+import bisect
+import threading
+import collections
+
+AMBIENT = 50
+PREAMBLE_TIME = 30
+PROFILE_KEYS = ("rampup", "ts", "Tsmin", "Tsmax", "tl", "Tl", "tp", "Tp", "rampdown")
+
+class Trajectory(object):
+    """
+    Piecewise-linear temperature trajectory of a reflow profile.
+    Segments are (begin temp, end temp, duration) tuples, times in seconds, temps in Celsius degrees.
+    """
+
+    def __init__(self, segments):
+        self._segments = tuple(segments)
+        self._begins = []
+        t = 0
+        for begin, end, duration in self._segments:
+            self._begins.append(t)
+            t += duration
+        self._duration = t
+        self._stepCache = {}
+        self._stepLock = threading.Lock()
+
+    @property
+    def segments(self):
+        return self._segments
+
+    @property
+    def duration(self):
+        return self._duration
+
+    def setPointAt(self, t):
+        """
+        Returns the setpoint at the given time, using a bisect lookup on the segment begin times.
+        """
+        if t <= 0:
+            return self._segments[0][0]
+        if t >= self._duration:
+            return self._segments[-1][1]
+        idx = bisect.bisect_right(self._begins, t) - 1
+        begin, end, duration = self._segments[idx]
+        if duration <= 0:
+            return end
+        return begin + (end - begin) * (t - self._begins[idx]) / duration
+
+    def setPointsAt(self, times):
+        """
+        Vectorized version of setPointAt(). Takes and returns NumPy arrays, falls back to lists without NumPy.
+        """
+        try:
+            import numpy
+        except ImportError:
+            return [self.setPointAt(t) for t in times]
+        knotTimes = [0]
+        knotTemps = [self._segments[0][0]]
+        for (begin, end, duration), segBegin in zip(self._segments, self._begins):
+            knotTimes.extend((segBegin, segBegin + duration))
+            knotTemps.extend((begin, end))
+        return numpy.interp(numpy.asarray(times, dtype=float), knotTimes, knotTemps)
+
+    def steps(self, timebase=0.5):
+        """
+        Returns the (timestamps, setpoints) tuples of the trajectory sampled at the given timebase.
+        Every segment is quantized to a whole number of steps, its last step being the segment's end temp.
+        The result is computed once per timebase and shared between the callers.
+        """
+        with self._stepLock:
+            try:
+                return self._stepCache[timebase]
+            except KeyError:
+                pass
+            setPoints = []
+            for begin, end, duration in self._segments:
+                stepNo = int(round(duration / timebase))
+                stepNo = 1 if stepNo == 0 else stepNo
+                stepWidth = (end - begin) / float(stepNo)
+                segSteps = [begin + i * stepWidth for i in range(stepNo)]
+                segSteps[-1] = end
+                setPoints.extend(segSteps)
+            timestamps = tuple(timebase * i for i in range(len(setPoints)))
+            steps = (timestamps, tuple(setPoints))
+            self._stepCache[timebase] = steps
+            return steps
+
+def _profileKey(profile):
+    return tuple(float(profile[key]) for key in PROFILE_KEYS)
+
+def _buildSegments(profile):
+    profile = dict(zip(PROFILE_KEYS, _profileKey(profile)))  # Floats, as in the cache key, no integer division
+    segments = []
+    # Preamble
+    segments.append((AMBIENT, AMBIENT, PREAMBLE_TIME))
+    # Ambient to preheat
+    rampupTime = (profile["Tsmin"] - AMBIENT) / profile["rampup"]
+    segments.append((AMBIENT, profile["Tsmin"], rampupTime))
+    # Preheat
+    segments.append((profile["Tsmin"], profile["Tsmax"], profile["ts"]))
+    # Preheat to Liquidous
+    tlTotpTime = tpTotlTime = (profile["tl"] - profile["tp"]) / 2.0
+    deltaTsmaxTl = profile["Tl"] - profile["Tsmax"]
+    deltaTlTp = profile["Tp"] - profile["Tl"]
+    slopeTsmaxTl = deltaTlTp / float(tlTotpTime)
+    durTsmaxTl = deltaTsmaxTl * (slopeTsmaxTl * 2.0)
+    segments.append((profile["Tsmax"], profile["Tl"], durTsmaxTl))
+    # Liquidous to Peak
+    segments.append((profile["Tl"], profile["Tp"], tlTotpTime))
+    # Reflow
+    segments.append((profile["Tp"], profile["Tp"], profile["tp"]))
+    # Back to Liquidous
+    segments.append((profile["Tp"], profile["Tl"], tpTotlTime))
+    # Cool down
+    coolDowmTime = (profile["Tl"] - AMBIENT) / profile["rampdown"]
+    segments.append((profile["Tl"], AMBIENT, coolDowmTime))
+    return segments
+
+class _LruCache(object):
+
+    def __init__(self, size):
+        self._size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, factory):
+        with self._lock:
+            try:
+                val = self._entries.pop(key)
+            except KeyError:
+                val = factory()
+                if len(self._entries) >= self._size:
+                    self._entries.popitem(last=False)
+            self._entries[key] = val
+            return val
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+_cache = _LruCache(256)
+
+def fromProfile(profile):
+    """
+    Returns the compiled Trajectory of a profile dict. Trajectories are kept in an LRU cache keyed on the profile's
+    parameters, so every profile with the same parameters shares one compiled instance.
+    """
+    return _cache.get(_profileKey(profile), lambda: Trajectory(_buildSegments(profile)))
@@ -1,14 +1,28 @@
 import sys
+import socket
 import threading
+import collections
 import readchar
 
 class Uif(object):
+    """
+    Console of the controller. The control threads never write the terminal: disp() only stores the latest values,
+    and msg() queues the message, while the renderer thread draws the queued messages and the status panel of the
+    enabled disp keys above the prompt, at most PANEL_RATE times per second.
+    """
+
+    PANEL_RATE = 5.0
+    MSG_BACKLOG = 1000
 
     def __init__(self, controller):
         self._cntrlr = controller
         self._listenerThread = None
+        self._rendererThread = None
         self._stopReq = threading.Event()
         self._dispState = {}
+        self._dispValues = {}
+        self._messages = collections.deque(maxlen=self.MSG_BACKLOG)
+        self._panel = []
         self._lineBufferRLock = threading.RLock()
         self._msgLock = threading.Lock()
         self._lineBuffer = ""
@@ -120,8 +134,8 @@ class Uif(object):
         """
         If called without parameters displays the "dispable" properties.
         If called with the prop name, without further parameters, then prints it one time.
-        If called with the prop name and "on" afterwards then periodically prints the prop until called the same prop
-        name with "off" parameter.
+        If called with the prop name and "on" afterwards then shows the prop in the status panel above the prompt until
+        called the same prop name with "off" parameter.
         """
         if param:
             if param.count(" "):
@@ -131,6 +145,7 @@ class Uif(object):
                 toState = "oneshot"
             try:
                 self._dispState[key] = toState
+                self._dispValues.pop(key, None)
             except Exception, e:
                 self._failed(e)
         else:
@@ -167,8 +182,29 @@ class Uif(object):
             self._cntrlr.loadProfile(param.strip().lower())
         else:
             self.msg("Avaiable profiles:\n")
-            for profile in self._cntrlr._profiles:
-                self.msg("\t" + profile["name"])
+            for name in self._cntrlr._profiles.names():
+                self.msg("\t" + name)
+
+    def _cmd_find(self, param):
+        """
+        find tag [name]
+        find peak low high
+        Lists the profiles with the given alloy or tag, or with peak temperature between low and high.
+        Without the tag name lists the known alloys and tags.
+        """
+        registry = self._cntrlr._profiles
+        args = param.split()
+        try:
+            if args[0] == "tag":
+                names = registry.byTag(args[1]) if len(args) > 1 else registry.tags()
+            elif args[0] == "peak":
+                names = registry.byPeak(float(args[1]), float(args[2]))
+            else:
+                raise ValueError("Unknown query %s" % args[0])
+        except (IndexError, ValueError) as e:
+            self._failed(e)
+            return
+        self.msg("\t" + "\n\t".join(names))
 
     def _cmd_save(self, param):
         """
@@ -181,6 +217,12 @@ class Uif(object):
             self.msg("You can save:\n\tpidcoeffs")
 
     def _cmd_tune(self, param):
+        """
+        Tunes the PID.
+        s: step response test on the oven.
+        b: bang-bang response test on the oven.
+        o: offline, by simulating candidate coefficients against the oven model; applies and saves the best one.
+        """
         self._cntrlr.autoTune(param)
 
     def _cmd_draw(self, param):
@@ -190,6 +232,194 @@ class Uif(object):
             enbable = True
         self._cntrlr.draw(enbable)
 
+    def _cmd_log(self, param):
+        """
+        log [on|off]
+        Displays or sets whether every PID cycle is logged. Every time turned on, logs to a new file.
+        """
+        if param in ("on", "off"):
+            self._cntrlr.enableLog(param == "on")
+        elif param:
+            self._failed("Unknown parameter %s" % param)
+        else:
+            self.msg("on" if self._cntrlr._logger is not None else "off")
+
+    def _cmd_link(self, param):
+        """
+        link [reset | decimation n | samples n]
+        Displays the serial link's protocol version and frame counters: decoded frames, bytes skipped during resync,
+        malformed frames, and with protocol v2 the frames lost according to the sequence numbers.
+        reset: clears the counters.
+        decimation: sets how many ADC reads the firmware averages into one sample.
+        samples: sets how many samples the firmware sends in one protocol v2 frame.
+        """
+        args = param.split()
+        if args == ["reset"]:
+            self._cntrlr._frameDecoder.resetCounters()
+            return
+        if len(args) == 2 and args[0] in ("decimation", "samples"):
+            try:
+                val = int(args[1])
+                if not 1 <= val <= 255:
+                    raise ValueError("Out of range: %d" % val)
+            except ValueError as e:
+                self._failed(e)
+                return
+            if args[0] == "decimation":
+                self._cntrlr.configureLink(decimation=val)
+            else:
+                self._cntrlr.configureLink(samplesPerFrame=val)
+            return
+        if args:
+            self._failed("Unknown parameter %s" % param)
+            return
+        self.msg("\t".join("%s: %d" % item for item in sorted(self._cntrlr.linkStats().items())))
+
+    def _cmd_jitter(self, param):
+        """
+        Displays the PID loop's timing: cycles, mean and max lateness to the deadline, mean period, period jitter and
+        overruns, in seconds. With the "reset" parameter clears the statistics.
+        """
+        if param == "reset":
+            self._cntrlr._pid.loopStats.reset()
+            return
+        self.msg("\t".join("%s: %.4g" % item for item in sorted(self._cntrlr._pid.loopStats.summary.items())))
+
+    def _cmd_filter(self, param):
+        """
+        filter [set spec [spec ...] | off | reset]
+        Displays the ADC filters: the group delay of each, in samples and milliseconds, and the noise of the samples
+        before and after each, in ADC codes.
+        set: replaces the filters, e.g. "filter set median:5 mean:4 iir:0.3". Refer to the adcfilter key of the
+             settings file for the specs.
+        off: removes the filters.
+        reset: clears the noise statistics.
+        """
+        args = param.split()
+        if args[:1] == ["set"] or args == ["off"]:
+            try:
+                self._cntrlr.setAdcFilter(args[1:])
+            except ValueError as e:
+                self._failed(e)
+            return
+        chain = self._cntrlr._adcFilter
+        if args == ["reset"]:
+            chain.resetStats()
+            return
+        if args:
+            self._failed("Unknown parameter %s" % param)
+            return
+        if not len(chain):
+            self.msg("No filters")
+            return
+        rate = chain.inputRate
+
+        def delayStr(samples):
+            return "%.1f samples" % samples + (" %.1f ms" % (samples / rate * 1e3) if rate else "")
+        lines = ["%s\tdelay: %s" % (chain, delayStr(chain.groupDelay))]
+        for name, stats in chain.stats():
+            lines.append("\t%-10s delay: %s\tnoise in: %.3f\tout: %.3f" %
+                         (name, delayStr(stats["delay"]), stats["noiseIn"], stats["noiseOut"]))
+        self.msg("\n".join(lines))
+
+    def _cmd_bus(self, param):
+        """
+        Displays the event bus subscribers: records delivered, dropped because the queue was full, pending in the
+        queue, and failed in the subscriber.
+        """
+        for topic, subscriber in self._cntrlr._bus.subscribers():
+            self.msg("%s/%s\t%s" % (topic, subscriber.name,
+                                    "\t".join("%s: %d" % item for item in sorted(subscriber.counters.items()))))
+
+    def _cmd_est(self, param):
+        """
+        est [on|off]
+        Displays the model based temperature estimator: the filtered temperature, the temperature predicted over the
+        oven's dead time, which the PID is fed with, and the heating rate in Celsius per second. While it is on, the
+        profile's setpoints are applied ahead by the dead time.
+        on: starts estimating with the oven model fitted by sysid.py, or the emulated oven's.
+        off: feeds the PID with the measured temperature again.
+        """
+        if param in ("on", "off"):
+            try:
+                self._cntrlr.enableEstimator(param == "on")
+            except ValueError as e:
+                self._failed(e)
+            return
+        if param:
+            self._failed("Unknown parameter %s" % param)
+            return
+        est = self._cntrlr._estimator
+        if est is None or est.temp is None:
+            self.msg("estimator %s" % ("off" if est is None else "on, no samples yet"))
+            return
+        self.msg("estimator on\tT: %.2f\tpredicted: %.2f in %.1f s\tdT/dt: %.3f" %
+                 (est.temp, est.predicted, est.horizon, est.rate))
+
+    def _cmd_telemetry(self, param):
+        """
+        telemetry [start address [address ...] | stop]
+        Displays the addresses of the telemetry server, and the clients connected: their decimation, and the records
+        sent, dropped because the client did not keep up, and pending.
+        start: streams on the addresses, tcp:host:port or unix:path, instead of the ones of the settings file.
+        stop: closes the server.
+        """
+        args = param.split()
+        if args[:1] == ["start"] and len(args) > 1:
+            try:
+                self._cntrlr.startTelemetry(args[1:])
+            except (ValueError, socket.error) as e:
+                self._failed(e)
+            return
+        if args == ["stop"]:
+            self._cntrlr.stopTelemetry()
+            return
+        if args:
+            self._failed("Unknown parameter %s" % param)
+            return
+        server = self._cntrlr._telemetry
+        if server is None:
+            self.msg("No telemetry server")
+            return
+        lines = ["listening on %s" % ", ".join(str(address) for address in server.addresses)]
+        for peer, counters in server.subscribers():
+            lines.append("\t%s\t%s" % (peer, "\t".join("%s: %d" % item for item in sorted(counters.items()))))
+        self.msg("\n".join(lines))
+
+    def _cmd_stats(self, param):
+        """
+        stats [on|off|reset]
+        Displays the latency histograms of the serial to PWM pipeline: sample age when the PID reads it, compute time,
+        CALC callback time, and end to end latency from the sample's arrival to the PWM write. Prints the count, mean,
+        50th, 90th and 99th percentiles and the maximum, in milliseconds. Recording is off until turned on.
+        """
+        stats = self._cntrlr._pid.latencyStats
+        if param in ("on", "off"):
+            stats.enabled = param == "on"
+        elif param == "reset":
+            stats.reset()
+        elif param:
+            self._failed("Unknown parameter %s" % param)
+        else:
+            lines = ["recording %s" % ("on" if stats.enabled else "off")]
+            for stage, count, mean, percentiles, maximum in stats.summary():
+                lines.append("%-9s n: %-7d mean: %-9.3f p50: %-9.3f p90: %-9.3f p99: %-9.3f max: %.3f" %
+                             ((stage, count, mean * 1e3) + tuple(pct * 1e3 for pct in percentiles) + (maximum * 1e3,)))
+            self.msg("\n".join(lines))
+
+    def _cmd_pidtrig(self, param):
+        """
+        Displays or sets what triggers the PID's computation:
+        deadline: computes on every sample time deadline with the latest sample.
+        sample: after the deadline waits for a fresh sample, and computes right when it arrives.
+        """
+        if param == "":
+            self.msg("sample" if self._cntrlr._pid.triggerOnSample else "deadline")
+        elif param in ("sample", "deadline"):
+            self._cntrlr._pid.triggerOnSample = param == "sample"
+        else:
+            self._failed("Unknown trigger %s" % param)
+
     def _cmd_man(self, param):
         """
         man [command]
@@ -214,28 +444,66 @@ class Uif(object):
             manstr = "Avaiable commands:\n\t" + "\n\t".join(funclist)
         self.msg(manstr)
 
+    def _formatDisp(self, args):
+        def pack(x):
+            try:
+                None in x
+            except:
+                x = (x,)
+            return x
+        return "\t".join(": ".join(str(sarg) for sarg in pack(arg)) for arg in args)
+
     def disp(self, key, *args):
-        try:
-            self._dispState[key]
-        except:
+        """
+        Stores the latest values of the key, for the status panel. Does not block on the terminal.
+        """
+        state = self._dispState.setdefault(key, "off")
+        if state == "oneshot":
             self._dispState[key] = "off"
-        if self._dispState[key] != "off":
-            def pack(x):
-                try:
-                    None in x
-                except:
-                    x = (x,)
-                return x
-            self.msg("\t".join(": ".join(str(sarg) for sarg in pack(arg)) for arg in args))
-            if self._dispState[key] == "oneshot":
-                self._dispState[key] = "off"
+            self.msg(self._formatDisp(args))
+        elif state != "off":
+            self._dispValues[key] = args
 
     def msg(self, msg):
+        if self._rendererThread is not None:
+            self._messages.append(str(msg))
+            return
         with self._msgLock:
             self._removePrompt()
             print(msg)
             self._addPrompt()
 
+    def _panelLines(self):
+        lines = []
+        for key in sorted(self._dispState):
+            args = self._dispValues.get(key)
+            if self._dispState.get(key) not in ("off", "oneshot") and args is not None:
+                lines.append("[%s] %s" % (key, self._formatDisp(args)))
+        return lines
+
+    def _render(self):
+        """
+        Redraws the queued messages, the status panel and the prompt, if anything changed.
+        """
+        messages = []
+        while self._messages:
+            messages.append(self._messages.popleft())
+        panel = self._panelLines()
+        if not messages and panel == self._panel:
+            return
+        with self._msgLock:
+            with self._lineBufferRLock:
+                sys.stdout.write("\r\x1b[K" + "\x1b[A\x1b[K" * len(self._panel))
+                for line in messages + panel:
+                    sys.stdout.write(line + "\n")
+                self._panel = panel
+                self._addPrompt()
+
+    def _renderLoop(self):
+        while not self._stopReq.wait(1.0 / self.PANEL_RATE):
+            self._render()
+        self._render()
+
     def _removePrompt(self):
         linebuff = self._getLineBuffer()
         sys.stdout.write("\r" + " " * (len(linebuff) + 2) + "\r")
@@ -325,6 +593,9 @@ class Uif(object):
             self._cntrlr.stop()
 
     def start(self):
+        self._rendererThread = threading.Thread(target=self._renderLoop)
+        self._rendererThread.daemon = True
+        self._rendererThread.start()
         self._listenerThread = threading.Thread(target=self.listen)
         self._listenerThread.start()
 
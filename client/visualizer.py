@@ -1,10 +1,22 @@
 import multiprocessing
 import Queue
-import time
+
+import clocks
 
 class Visualizer:
+    """
+    Plots the reference profile and the live temperature in a separate process.
+    Live samples are written to a ring buffer in shared memory, without pickling, and the drawing process takes
+    them in batches. Only the live line is redrawn, by blitting it over the saved background.
+    """
+
+    LIVE_CAPACITY = 8192
+    REFRESH_INTERVAL = 0.2
 
-    def __init__(self):
+    def __init__(self, clock=None):
+        if clock is None:
+            clock = clocks.RealClock()
+        self._clock = clock
         self._drawProcess = multiprocessing.Process(target=self._draw)
         self._graphData = multiprocessing.Queue()
         self._stopReq = multiprocessing.Event()
@@ -13,9 +25,25 @@ class Visualizer:
         self._clearDone = multiprocessing.Event()
         self._drawLive = multiprocessing.Event()
         self._scrollLive = multiprocessing.Event()
+        self._liveData = multiprocessing.Array("d", 2 * self.LIVE_CAPACITY, lock=False)
+        self._liveCount = multiprocessing.Value("L", 0)
         self._startTime = 0
         self._processStarted = False
 
+    def _readLive(self, readCount, liveDataX, liveDataY):
+        """
+        Appends the samples written since readCount to the lists, returns the new read count.
+        Samples overwritten in the meantime are lost.
+        """
+        with self._liveCount.get_lock():
+            writeCount = self._liveCount.value
+        readCount = max(readCount, writeCount - self.LIVE_CAPACITY)
+        for i in xrange(readCount, writeCount):
+            idx = 2 * (i % self.LIVE_CAPACITY)
+            liveDataX.append(self._liveData[idx])
+            liveDataY.append(self._liveData[idx + 1])
+        return writeCount
+
     def _draw(self):
         from matplotlib import pyplot as plot
         fig, axes = plot.subplots()
@@ -24,32 +52,36 @@ class Visualizer:
         plot.ion()
         plot.grid()
         plot.show()
+        background = [None]
+
+        def saveBackground(event):
+            background[0] = fig.canvas.copy_from_bbox(axes.bbox)
+        fig.canvas.mpl_connect('draw_event', saveBackground)
         while not self._exitReq.is_set():
             refDataX, refDataY = self._graphData.get()
-            refDataLen = len(refDataX)
+            with self._liveCount.get_lock():
+                readCount = self._liveCount.value
             liveDataX = []
             liveDataY = []
             axes.plot(refDataX, refDataY, "b-")
-            liveDataLine, = axes.plot(liveDataX, liveDataY, "r-")
+            liveDataLine, = axes.plot(liveDataX, liveDataY, "r-", animated=True)
             axes.set_xlim([0, refDataX[-1] * 1.1])
             axes.set_ylim([min(refDataX) * 0.9, max(refDataY) * 1.1])
-            plot.draw()
+            fig.canvas.draw()
             while not self._stopReq.is_set():
-                try:
-                    while True:
-                        newPoint = self._graphData.get(block=False)
-                        liveDataY.append(newPoint[1])
-                        liveDataX.append(newPoint[0])
-                        liveDataLine.set_xdata(liveDataX)
-                        liveDataLine.set_ydata(liveDataY)
-                except Queue.Empty:
-                    pass
-                plot.pause(1)
+                lastCount = readCount
+                readCount = self._readLive(readCount, liveDataX, liveDataY)
+                if readCount != lastCount and background[0] is not None:
+                    liveDataLine.set_data(liveDataX, liveDataY)
+                    fig.canvas.restore_region(background[0])
+                    axes.draw_artist(liveDataLine)
+                    fig.canvas.blit(axes.bbox)
+                fig.canvas.start_event_loop(self.REFRESH_INTERVAL)
             while not self._clearReq.is_set():
-                plot.pause(1)
+                fig.canvas.start_event_loop(self.REFRESH_INTERVAL)
             for line in axes.lines:
                 line.remove()
-            plot.draw()
+            fig.canvas.draw()
             self._clearQueue()
             self._clearReq.clear()
             self._clearDone.set()
@@ -83,7 +115,7 @@ class Visualizer:
         self._startTime = 0
         self._stopReq.clear()
         self._drawLive.set()
-        self._startTime = time.time()
+        self._startTime = self._clock.now()
 
     def disableLive(self):
         self._stopReq.set()
@@ -95,12 +127,42 @@ class Visualizer:
         else:
             self._scrollLive.clear()
 
-    def update(self, value):
-        elapsed = time.time() - self._startTime
+    def update(self, value, timestamp=None):
+        """
+        Adds a live sample, taken at the given time of the clock, or now.
+        """
         if self._drawLive.is_set():
-            self._graphData.put((elapsed, value))
+            elapsed = (self._clock.now() if timestamp is None else timestamp) - self._startTime
+            with self._liveCount.get_lock():
+                idx = 2 * (self._liveCount.value % self.LIVE_CAPACITY)
+                self._liveData[idx] = elapsed
+                self._liveData[idx + 1] = value
+                self._liveCount.value += 1
 
     def stop(self):
         self.disableLive()
         self._clearReq.set()
         self._exitReq.set()
+
+class NullVisualizer(object):
+    """
+    Stand-in for Visualizer when there is nothing to plot on.
+    """
+
+    def init(self, refData):
+        pass
+
+    def enableLive(self):
+        pass
+
+    def disableLive(self):
+        pass
+
+    def scrollLive(self, enable):
+        pass
+
+    def update(self, value, timestamp=None):
+        pass
+
+    def stop(self):
+        pass
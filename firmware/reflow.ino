@@ -1,7 +1,21 @@
+#include <util/crc16.h>
+
 #define D13 13
 #define PWM_PIN  D13
 #define ADC_PIN  A5
 
+// Host to device commands: CMD_SYNC, command, argument, CRC-8 of the command and the argument
+#define CMD_SYNC        0xA5
+#define CMD_PWM         0x01
+#define CMD_DECIMATION  0x02
+#define CMD_SAMPLES     0x03
+#define CMD_PROTOCOL    0x04
+
+// Protocol v2 frame: 0xA5 0x5A, version, sequence number, time in ms (4 bytes), sample count, samples (2 bytes
+// each), CRC-16 of everything after the sync. Little endian.
+#define V2_VERSION      2
+#define V2_MAX_SAMPLES  32
+
 int adc;
 char *pAdc;
 int pwmLvl = 1;
@@ -9,20 +23,116 @@ int pwmStep = 0;
 int pwmCntr = 0;
 bool isOn = false;
 
+uint8_t protocol = 1;
+uint8_t decimation = 1;
+uint8_t samplesPerFrame = 1;
+uint32_t adcSum = 0;
+uint8_t adcCount = 0;
+uint16_t samples[V2_MAX_SAMPLES];
+uint8_t sampleCount = 0;
+uint8_t seq = 0;
+
+uint8_t cmdBuf[4];
+uint8_t cmdLen = 0;
+int pwmBeforeCmd = 0;
+
 void setup() {
   pAdc = (char*)&adc;
   Serial.begin(57600);
   pinMode(D13, OUTPUT);
 }
 
+uint16_t writeCrc(uint16_t crc, const uint8_t *data, uint8_t len) {
+  Serial.write(data, len);
+  while (len--) {
+    crc = _crc_ccitt_update(crc, *data++);
+  }
+  return crc;
+}
+
+void sendFrame() {
+  uint8_t header[7];
+  uint32_t now = millis();
+  uint16_t crc = 0xFFFF;
+  header[0] = V2_VERSION;
+  header[1] = seq++;
+  memcpy(header + 2, &now, 4);
+  header[6] = sampleCount;
+  Serial.write(0xA5);
+  Serial.write(0x5A);
+  crc = writeCrc(crc, header, sizeof(header));
+  crc = writeCrc(crc, (uint8_t*)samples, sampleCount * 2);
+  Serial.write((uint8_t*)&crc, 2);
+  sampleCount = 0;
+}
+
+void execCommand(uint8_t cmd, uint8_t arg) {
+  switch (cmd) {
+    case CMD_PWM:
+      pwmLvl = arg;
+      break;
+    case CMD_DECIMATION:
+      decimation = arg ? arg : 1;
+      break;
+    case CMD_SAMPLES:
+      samplesPerFrame = constrain(arg, 1, V2_MAX_SAMPLES);
+      break;
+    case CMD_PROTOCOL:
+      if (arg == 1 || arg == 2) {
+        protocol = arg;
+        pwmLvl = 0;
+        adcSum = 0;
+        adcCount = 0;
+        sampleCount = 0;
+      }
+      break;
+  }
+}
+
+// In the legacy protocol every byte is a PWM level, except the bytes of a valid command. In v2 only commands.
+void handleByte(uint8_t b) {
+  if (protocol == 1) {
+    if (cmdLen == 0) {
+      pwmBeforeCmd = pwmLvl;
+    }
+    pwmLvl = b;
+  }
+  if (cmdLen == 0 && b != CMD_SYNC) {
+    return;
+  }
+  cmdBuf[cmdLen++] = b;
+  if (cmdLen < 4) {
+    return;
+  }
+  cmdLen = 0;
+  if (_crc8_ccitt_update(_crc8_ccitt_update(0, cmdBuf[1]), cmdBuf[2]) == cmdBuf[3]) {
+    if (protocol == 1) {
+      pwmLvl = pwmBeforeCmd;
+    }
+    execCommand(cmdBuf[1], cmdBuf[2]);
+  }
+}
+
 void loop() {
   adc = analogRead(ADC_PIN);
-  Serial.write(0xFF);
-  Serial.write(pAdc, 2);
+  if (protocol == 1) {
+    Serial.write(0xFF);
+    Serial.write(pAdc, 2);
+  } else {
+    adcSum += adc;
+    if (++adcCount >= decimation) {
+      samples[sampleCount++] = (adcSum + adcCount / 2) / adcCount;
+      adcSum = 0;
+      adcCount = 0;
+      if (sampleCount >= samplesPerFrame) {
+        sendFrame();
+      }
+    }
+  }
   //delay(100);
-  
-  if(Serial.available()) {
-    pwmLvl = Serial.read();
+
+  while(Serial.available()) {
+    handleByte(Serial.read());
   }
   if((pwmLvl > pwmStep) && !isOn) {
     digitalWrite(PWM_PIN, HIGH);
@@ -39,5 +149,3 @@ void loop() {
     pwmStep = 0;
   }
 }
-
-